@@ -2,13 +2,25 @@
 
 """Nagios plugin to check the existence and freshness of a valid backup"""
 
-import argparse
+import time
+
+# reference for the startup time reported by --trace
+_start_time = time.perf_counter()
+
+# modules only needed by some features (asyncio, sqlite3, statistics,
+# dateutil) or only by main() (argparse) are imported where they are used
+import atexit
 import logging
-import subprocess
 import os
 import datetime
 import collections
+import contextlib
+import functools
+import itertools
+import json
 import re
+import stat
+import threading
 
 try:
 	import nagiosplugin
@@ -16,15 +28,110 @@ except ImportError as e:
     print("Please install python3-nagiosplugin")
     raise e
 
-try:
-    import dateutil.parser
-except ImportError as e:
-    print("Please install python3-dateutil")
-    raise e
-
 
 _log = logging.getLogger('nagiosplugin')
 
+# metrics counting seconds since a point in time, they grow while cached
+AGE_METRICS = ('last_success', 'last_try', 'running_backup_for', 'lock_age')
+
+
+def parse_timestamp(timestamp):
+    """Parses the backup-begin and backup-complete values of a summary file.
+
+    dirvish writes them as '%Y-%m-%d %H:%M:%S', which datetime parses directly.
+    Other formats are left to dateutil, which is only imported if needed.
+    """
+    try:
+        return datetime.datetime.fromisoformat(timestamp)
+    except ValueError:
+        pass
+    try:
+        import dateutil.parser
+    except ImportError as e:
+        print("Please install python3-dateutil")
+        raise e
+    return dateutil.parser.parse(timestamp)
+
+
+# the status line of a summary, as written by dirvish:
+#   success
+#   warning (24) -- file vanished on sender
+#   (255) --
+STATUS_RE = re.compile(r"""
+                (?P<status>\w+)? \s*              # success|warning|fatal|error|unknown
+                (\((?P<rsyncexitcode>\d+)\))? \s* # rsync exitcode
+                (--)? \s*                         # separator
+                (?P<description>.*)?              # description
+             """, re.IGNORECASE|re.VERBOSE)
+
+BackupStatus = collections.namedtuple('BackupStatus', 'status rsync_exit_code description')
+
+
+def parse_status(status):
+    """Returns the BackupStatus of the status line of a summary file.
+
+    rsync_exit_code is an int or None, the missing fields are empty strings.
+    """
+    statusD = STATUS_RE.match(status).groupdict()
+    exit_code = statusD['rsyncexitcode']
+    return BackupStatus(statusD['status'] or '', int(exit_code) if exit_code is not None else None,
+                        statusD['description'] or '')
+
+
+def parse_summary(lines, parameterL):
+    """Returns a dict of the parameters of parameterL found in the lines of a summary file.
+
+    A parameter is a line 'Key: value'. Keys are case insensitive, the dict
+    has the casefolded ones. Reading stops as soon as all parameters are found.
+    """
+    wantedS = {parameter.casefold() for parameter in parameterL}
+    resultD = dict()
+    for line in lines:
+        if ': ' not in line:
+            # most lines are excludes and rsync options
+            continue
+        key, separator, value = line.strip().partition(': ')
+        if not separator:
+            continue
+        key = key.casefold()
+        if key in wantedS:
+            # a value containing ': ' is joined with ' ', like dirvish does
+            resultD[key] = value.replace(': ', ' ')
+            wantedS.discard(key)
+            if not wantedS:
+                break
+    return resultD
+
+
+# the rsync errors counted in the log of an image, the messages contain the errno
+LOG_ERRORS = {
+    'vanished_files': b'file has vanished: ',
+    'permission_denied': b'Permission denied (13)',
+    'io_errors': b'Input/output error (5)',
+}
+
+
+def count_log_errors(f, blocksize=65536):
+    """Returns a Counter of the rsync errors of LOG_ERRORS in the binary file f.
+
+    f is read in blocks of blocksize, so a compressed log is decompressed
+    block by block and never held in memory as a whole. The end of a block,
+    one byte shorter than the longest message, is searched again with the
+    next block for the messages split by the blocks.
+    """
+    overlap = max(map(len, LOG_ERRORS.values())) - 1
+    counter = collections.Counter({error: 0 for error in LOG_ERRORS})
+    carry = b''
+    while True:
+        block = f.read(blocksize)
+        if not block:
+            return counter
+        data = carry + block
+        for error, message in LOG_ERRORS.items():
+            # only the messages reaching into the new block, the others were counted already
+            counter[error] += data.count(message, max(len(carry) - len(message) + 1, 0))
+        carry = data[-overlap:]
+
 
 class E_PathNotAccessible(Exception):
     def __init__(self, value):
@@ -62,16 +169,425 @@ class E_FileNotAccessible(Exception):
     def __str__(self):
         return "File %r is not accessible" %repr(self.value)
 
+class Instrumentation(object):
+    """Wall time spent in the phases of a probe and counters of its I/O.
+
+    Phases are exclusive: the time of a nested phase is not counted for the
+    enclosing one.
+    """
+
+    def __init__(self):
+        self.phaseD = collections.defaultdict(float)
+        self.counterD = collections.Counter()
+        self._stack = []    # [phase, start of the not yet counted time]
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        now = time.perf_counter()
+        if self._stack:
+            self.phaseD[self._stack[-1][0]] += now - self._stack[-1][1]
+        current = [name, now]
+        self._stack.append(current)
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            self.phaseD[name] += now - current[1]
+            self._stack.pop()
+            if self._stack:
+                self._stack[-1][1] = now
+
+    def timed(self, name, iterable):
+        """Yields the items of iterable, counting the time to get them for phase name"""
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def count(self, name, n=1):
+        self.counterD[name] += n
+
+    def as_dict(self):
+        return {'phases': dict(self.phaseD), 'counters': dict(self.counterD)}
+
+
+def duration_statistics(durations, alpha=0.3):
+    """Returns median, 95th percentile and the exponentially weighted moving
+    average (weight alpha for the newest value) of durations, newest first.
+    """
+    import statistics
+    ewma = durations[-1]
+    for duration in reversed(durations[:-1]):
+        ewma = alpha * duration + (1 - alpha) * ewma
+    return {
+        'median': statistics.median(durations),
+        'p95': statistics.quantiles(durations, n=20, method='inclusive')[18] if len(durations) > 1 else durations[0],
+        'ewma': ewma,
+    }
+
+
+def reverse_lines(fd, blocksize=8192, instrumentation=None):
+    """Yields (offset, line) of the file fd from the last line to the first.
+
+    The file is read backwards in blocks of blocksize bytes, so the memory
+    needed is bounded by the blocksize and the longest line. Lines are
+    bytes without the line break. The bytes read are counted as 'bytes_read'
+    of instrumentation.
+    """
+    end = os.fstat(fd).st_size
+    # the bytes of the (incomplete) line following the block read last
+    tail = b''
+    # a line break at the end of the file does not start an empty line
+    if end > 0 and os.pread(fd, 1, end - 1) == b'\n':
+        end -= 1
+    while end > 0:
+        start = max(0, end - blocksize)
+        block = os.pread(fd, end - start, start) + tail
+        if instrumentation is not None:
+            instrumentation.count('bytes_read', end - start)
+        lineL = block.split(b'\n')
+        # position behind the last line of the block
+        position = start + len(block)
+        for line in reversed(lineL[1:]):
+            position -= len(line)
+            yield position, line
+            position -= 1
+        # the first part may continue in the previous block
+        tail = lineL[0]
+        end = start
+    yield 0, tail
+
+
+class FileSystem(object):
+    """Memoized view of the filesystem for the duration of one run.
+
+    Every directory is listed at most once with os.scandir, and every path is
+    stat'ed at most once. If the parent of a path was listed already, its
+    type and stat are taken from the cached DirEntry instead, e.g. the images
+    in the listing of the vault. Changes made during the run are not seen.
+    Threads may share a FileSystem, at worst a path is then looked up twice.
+    """
+
+    def __init__(self):
+        self.entryD = dict()    # directory -> {name: DirEntry} or the OSError listing it
+        self.statD = dict()     # path -> stat result or OSError
+        self.accessD = dict()   # (path, mode) -> bool
+        self._local = threading.local()
+        # the processes running during the run, for the lock files
+        self.processes = ProcessTable()
+
+    @property
+    def counterD(self):
+        """The syscalls done by the current thread, see Instrumentation"""
+        try:
+            return self._local.counterD
+        except AttributeError:
+            self._local.counterD = collections.Counter()
+            return self._local.counterD
+
+    def entries(self, directory):
+        """Returns a dict of name to DirEntry of directory, raises OSError like os.scandir"""
+        directory = os.path.normpath(directory)
+        if directory not in self.entryD:
+            self.counterD['directories_listed'] += 1
+            try:
+                with os.scandir(directory) as it:
+                    self.entryD[directory] = {entry.name: entry for entry in it}
+            except OSError as e:
+                self.entryD[directory] = e
+        entryD = self.entryD[directory]
+        if isinstance(entryD, OSError):
+            raise entryD
+        return entryD
+
+    def listdir(self, directory):
+        return list(self.entries(directory))
+
+    def listed_entry(self, path):
+        """Returns the DirEntry of path from the listing of its parent,
+        None if it is not in the listing, raises KeyError if the parent
+        was not listed"""
+        parent, name = os.path.split(os.path.normpath(path))
+        entryD = self.entryD[parent]
+        if isinstance(entryD, OSError):
+            raise KeyError(parent)
+        return entryD.get(name)
+
+    def stat(self, path):
+        """Returns the stat result of path, raises OSError like os.stat"""
+        path = os.path.normpath(path)
+        try:
+            entry = self.listed_entry(path)
+        except KeyError:
+            if path not in self.statD:
+                self.counterD['stat_calls'] += 1
+                try:
+                    self.statD[path] = os.stat(path)
+                except OSError as e:
+                    self.statD[path] = e
+            if isinstance(self.statD[path], OSError):
+                raise self.statD[path]
+            return self.statD[path]
+        if entry is None:
+            raise FileNotFoundError(path)
+        return entry.stat()
+
+    def is_dir(self, path):
+        try:
+            entry = self.listed_entry(path)
+        except KeyError:
+            pass
+        else:
+            # without a stat, if the filesystem returns the type in the listing
+            return entry is not None and entry.is_dir()
+        try:
+            return stat.S_ISDIR(self.stat(path).st_mode)
+        except OSError:
+            return False
+
+    def is_file(self, path):
+        try:
+            return stat.S_ISREG(self.stat(path).st_mode)
+        except OSError:
+            return False
+
+    def access(self, path, mode):
+        key = (os.path.normpath(path), mode)
+        if key not in self.accessD:
+            self.counterD['access_calls'] += 1
+            self.accessD[key] = os.access(path, mode)
+        return self.accessD[key]
+
+
+Process = collections.namedtuple('Process', 'pid start_time cmdline comm')
+
+
+class ProcessTable(object):
+    """Memoized view of the running processes for the duration of one run.
+
+    /proc is listed once for all vaults, the stat, cmdline and comm files are
+    only read for the pids asked for. start_time is seconds since the epoch,
+    cmdline the tuple of arguments, comm the name of the executable. Without
+    /proc, for a pid hidden in /proc (hidepid=2) or with unreadable files
+    (hidepid=1) a process is looked up with kill(pid, 0), and start_time,
+    cmdline and comm are None.
+    """
+
+    def __init__(self, proc='/proc'):
+        self.proc = proc
+        self._pidS = None
+        self._boot_time = None
+        self.processD = dict()  # pid -> Process or None
+
+    def pids(self):
+        """Returns the set of running pids, or None if /proc is not available"""
+        if self._pidS is None:
+            try:
+                self._pidS = {int(name) for name in os.listdir(self.proc) if name.isdigit()}
+            except OSError as e:
+                _log.info("Cannot list %r: %s", self.proc, e)
+                self._pidS = False
+        return self._pidS or None
+
+    def boot_time(self):
+        if self._boot_time is None:
+            with open(os.path.join(self.proc, 'stat')) as f:
+                for line in f:
+                    if line.startswith('btime '):
+                        self._boot_time = int(line.split()[1])
+                        break
+        return self._boot_time
+
+    def read_process(self, pid):
+        try:
+            with open(os.path.join(self.proc, str(pid), 'stat')) as f:
+                stat_line = f.read()
+            with open(os.path.join(self.proc, str(pid), 'cmdline'), 'rb') as f:
+                cmdline = f.read()
+            with open(os.path.join(self.proc, str(pid), 'comm')) as f:
+                comm = f.read().rstrip('\n')
+        except (FileNotFoundError, ProcessLookupError):
+            # the process has terminated since the listing
+            return None
+        except OSError as e:
+            # e.g. /proc mounted with hidepid=1
+            _log.info("Cannot read process %d: %s", pid, e)
+            return self.signal_process(pid)
+        # the command name in parentheses may contain spaces and parentheses,
+        # starttime is the 22nd field, the 20th after the command name
+        fieldL = stat_line[stat_line.rindex(')') + 2:].split()
+        start_time = self.boot_time() + int(fieldL[19]) / os.sysconf('SC_CLK_TCK')
+        return Process(pid, start_time, tuple(arg.decode(errors='replace') for arg in cmdline.split(b'\0') if arg),
+                       comm)
+
+    @staticmethod
+    def signal_process(pid):
+        """Returns the Process pid without details if it is running, or None"""
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return None
+        except OSError:
+            # e.g. EPERM, the process exists
+            pass
+        return Process(pid, None, None, None)
+
+    def process(self, pid):
+        """Returns the running Process pid, or None"""
+        if pid not in self.processD:
+            pidS = self.pids()
+            if pidS is not None and pid in pidS:
+                self.processD[pid] = self.read_process(pid)
+            else:
+                # without /proc, or the pid is hidden by hidepid=2
+                self.processD[pid] = self.signal_process(pid)
+        return self.processD[pid]
+
+
+class SummaryCache(object):
+    """Parsed summary files of dirvish images, stored in a sqlite database.
+
+    The summary of a completed image never changes. An entry is valid as long
+    as inode, mtime and size of the summary file match, so a cached image
+    costs one stat instead of reading and parsing the summary. The counts of
+    the rsync errors in the log files are cached the same way.
+    """
+
+    # the parameters stored for every image
+    parameterL = ['status', 'backup-begin', 'backup-complete', 'branch']
+
+    def __init__(self, filename):
+        self.filename = filename
+        import sqlite3
+        self.OperationalError = sqlite3.OperationalError
+        # the vaults of a bank may be probed in several threads, see ProbeEngine
+        self.db = sqlite3.connect(filename, timeout=10, check_same_thread=False)
+        self.lock = threading.Lock()
+        try:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS summary (
+                                vault TEXT, image TEXT,
+                                inode INTEGER, mtime_ns INTEGER, size INTEGER,
+                                parameters TEXT,
+                                PRIMARY KEY (vault, image))""")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS log_errors (
+                                vault TEXT, image TEXT,
+                                inode INTEGER, mtime_ns INTEGER, size INTEGER,
+                                errors TEXT,
+                                PRIMARY KEY (vault, image))""")
+            self.db.commit()
+        except self.OperationalError as e:
+            _log.warning("Cannot initialize summary cache %r: %s", filename, e)
+
+    def get(self, vault_base_path, image, st):
+        """Returns the cached parameters of image if its summary file is unchanged"""
+        try:
+            with self.lock:
+                row = self.db.execute("SELECT inode, mtime_ns, size, parameters FROM summary "
+                                      "WHERE vault = ? AND image = ?", (vault_base_path, image)).fetchone()
+        except self.OperationalError as e:
+            _log.warning("Cannot read summary cache %r: %s", self.filename, e)
+            return None
+        if row is None or tuple(row[:3]) != (st.st_ino, st.st_mtime_ns, st.st_size):
+            return None
+        return json.loads(row[3])
+
+    def put(self, vault_base_path, image, st, parameterD):
+        try:
+            with self.lock:
+                self.db.execute("INSERT OR REPLACE INTO summary VALUES (?, ?, ?, ?, ?, ?)",
+                                (vault_base_path, image, st.st_ino, st.st_mtime_ns, st.st_size,
+                                 json.dumps(parameterD)))
+        except self.OperationalError as e:
+            _log.warning("Cannot write summary cache %r: %s", self.filename, e)
+
+    def get_log_errors(self, vault_base_path, image, st):
+        """Returns the cached counts of count_log_errors() of image if its log file is unchanged"""
+        try:
+            with self.lock:
+                row = self.db.execute("SELECT inode, mtime_ns, size, errors FROM log_errors "
+                                      "WHERE vault = ? AND image = ?", (vault_base_path, image)).fetchone()
+        except self.OperationalError as e:
+            _log.warning("Cannot read summary cache %r: %s", self.filename, e)
+            return None
+        if row is None or tuple(row[:3]) != (st.st_ino, st.st_mtime_ns, st.st_size):
+            return None
+        return collections.Counter(json.loads(row[3]))
+
+    def put_log_errors(self, vault_base_path, image, st, counter):
+        try:
+            with self.lock:
+                self.db.execute("INSERT OR REPLACE INTO log_errors VALUES (?, ?, ?, ?, ?, ?)",
+                                (vault_base_path, image, st.st_ino, st.st_mtime_ns, st.st_size,
+                                 json.dumps(counter)))
+        except self.OperationalError as e:
+            _log.warning("Cannot write summary cache %r: %s", self.filename, e)
+
+    def evict(self, vault_base_path, imageS):
+        """Removes the entries of all images of the vault not in imageS, e.g. expired images"""
+        try:
+            with self.lock:
+                for table in ('summary', 'log_errors'):
+                    cachedS = {row[0] for row in self.db.execute(
+                        "SELECT image FROM %s WHERE vault = ?" % table, (vault_base_path,))}
+                    for image in cachedS - set(imageS):
+                        _log.debug("Evict image %r from the %s cache", image, table)
+                        self.db.execute("DELETE FROM %s WHERE vault = ? AND image = ?" % table,
+                                        (vault_base_path, image))
+        except self.OperationalError as e:
+            _log.warning("Cannot evict from summary cache %r: %s", self.filename, e)
+
+    def commit(self):
+        try:
+            with self.lock:
+                self.db.commit()
+        except self.OperationalError as e:
+            _log.warning("Cannot write summary cache %r: %s", self.filename, e)
+
+
 class Backup(nagiosplugin.Resource):
     """Domain model: Dirvish vaults"""
 
-    def __init__(self, vault, base_path, branch='default'):
+    # durations needed to compute duration_stats
+    min_duration_history = 3
+
+    def __init__(self, vault, base_path, branch='default', metric_prefix='', summary_cache=None,
+                 duration_history=0, fs=None, perf_internals=False, scan=None, scan_log=False):
         self.vault = vault
+        # emit the Instrumentation of the probe as metrics
+        self.perf_internals = perf_internals
+        self.instrumentation = Instrumentation()
+        # a FileSystem shared by all vaults of a run, the vault gets its own by default
+        self.fs = fs if fs is not None else FileSystem()
         self.base_path = base_path
         self.branch = branch
+        # number of durations of successful backups before the last one to compute duration_stats from
+        self.duration_history = duration_history
+        self.recent_durations = []
+        self.duration_stats = None
+        # a SummaryCache or None
+        self.summary_cache = summary_cache
+        self.image_directories = set()
+        # prefix for metric names, so several vaults can share one check
+        self.metric_prefix = metric_prefix
         self.vault_base_path = os.path.join(self.base_path, self.vault)
+        self.lock_file = os.path.join(self.vault_base_path, 'dirvish', 'lock_file')
         self.valid_backup_found = 0
         self.backup_running_now = 0
+        # count the rsync errors in the log of the newest completed image
+        self.scan_log = scan_log
+        self.log_errors = None
+        # the error, if the log of the newest completed image could not be scanned
+        self.log_error = None
+        self.last_try_image = None
+        # a VaultScan classifying the images for the other branches of the vault too
+        self.scan = scan
+        if scan is not None:
+            scan.add(self)
 
     @property
     def name(self):
@@ -79,50 +595,131 @@ class Backup(nagiosplugin.Resource):
         return "%s %s" % (self.__class__.__name__, self.vault.split('.')[0])
 
 
+    def metric(self, name, value, context=None, **kwargs):
+        """Create a metric evaluated by the context `name`, or `context` if given."""
+        return nagiosplugin.Metric(self.metric_prefix + name, value, context=context or name, **kwargs)
+
     def check_path_accessible(self, directory):
         _log.debug("Check if %r is accessible and a directory", directory)
-        if not os.access(directory, os.R_OK | os.X_OK):
-            raise E_PathNotAccessible(directory)
-        if not os.path.isdir(directory):
-            raise E_PathNoDir(directory)
+        with self.instrumentation.phase('accessibility'):
+            if not self.fs.access(directory, os.R_OK | os.X_OK):
+                raise E_PathNotAccessible(directory)
+            if not self.fs.is_dir(directory):
+                raise E_PathNoDir(directory)
         return
 
     def check_file_accessible(self, filename):
         _log.debug("Check if %r is accessible", filename)
-        if not os.access(filename, os.R_OK):
-            raise E_FileNotAccessible(filename)
+        with self.instrumentation.phase('accessibility'):
+            if not self.fs.access(filename, os.R_OK):
+                raise E_FileNotAccessible(filename)
         return
 
+    # files that should be in every dirvish backup directory:
+    mustHaveS = frozenset({'summary', 'tree'})
+    # the names of the log file of an image, one of them is needed,
+    # dirvish compresses the log with log-compress
+    log_files = ('log', 'log.gz', 'log.bz2')
+
+    def history(self, branch=None):
+        """Returns a iterator of the images listed in the history file of branch, newest first
+
+        The file is read backwards, so only its tail is read if the
+        iteration is stopped early.
+        """
+        history_file = os.path.join(self.vault_base_path, 'dirvish', f'{branch or self.branch}.hist')
+        _log.debug('Check for %r' % history_file)
+        if not self.fs.access(history_file, os.R_OK):
+            return
+        with open(history_file, 'rb') as histfile:
+            self.instrumentation.count('files_opened')
+            for offset, entry in reverse_lines(histfile.fileno(), instrumentation=self.instrumentation):
+                # the first line is the header of the table
+                if offset == 0:
+                    break
+                image = entry.decode(errors='replace').strip().split('\t')[0]
+                if image:
+                    yield image
+
+    def is_backup_directory(self, directory):
+        """checks if directory contains all files of a dirvish image"""
+        self.saved_directory_reads -= 1
+        dirCont = set(self.fs.listdir(os.path.join(self.vault_base_path, directory)))
+        return self.mustHaveS.issubset(dirCont) and not dirCont.isdisjoint(self.log_files)
+
     def backups(self):
-        """Returns a iterable of backup-sub-directories"""
+        """Returns a iterator of backup-sub-directories, newest first
+
+        The history file is trusted if its newest image exists. Only the
+        directories newer than this image (e.g. a running backup, which is not
+        yet in the history) are listed to find images, the others are
+        returned in the order of the history file. Without a usable history
+        file the directories are listed newest first while iterating, so
+        stopping the iteration early saves listing the older ones.
+        """
         _log.debug(f"Finding the latest backup for vault {self.vault} - {self.branch}")
         self.history_file = os.path.join(self.vault_base_path, 'dirvish', f'{self.branch}.hist')
-        self.lock_file = os.path.join(self.vault_base_path, 'dirvish', 'lock_file')
-        _log.debug('Check for %r' % self.history_file)
-        resultS = set()
-        if os.access(self.history_file, os.R_OK):
-            with open(self.history_file) as histfile:
-                lines = histfile.readlines()[1:]
-            for entry in reversed(lines):
-                try:
-                    last_entry = entry.strip()
-                    image = last_entry.split('\t')[0]
-                    _log.info("Found next backup in %r", image)
-                except Exception as e:
-                    _log.error("Something unexpected happened, while reading file %r", self.history_file)
-                    next
-                resultS.add(image)
-        for _, dirnames, _ in os.walk(self.vault_base_path):
-            _log.info("Adding directories in %r", self.vault_base_path)
-            # files that should be in every dirvish backup directory:
-            mustHaveS = {'log', 'summary', 'tree'}
-            for directory in dirnames:
-                dirCont = set(os.listdir(os.path.join(self.vault_base_path, directory)))
-                if mustHaveS.issubset(dirCont):
-                    resultS.add(directory)
-            dirnames.clear()
-        _log.info("Found possible backups: %r", resultS)
-        return resultS
+        history = self.history()
+        newest = next(history, None)
+        directoryS = {name for name, entry in self.fs.entries(self.vault_base_path).items() if entry.is_dir()}
+        directoryS.discard('dirvish')
+        self.image_directories = directoryS
+        # decremented by every directory listed in is_backup_directory
+        self.saved_directory_reads = len(directoryS)
+        try:
+            if newest in directoryS:
+                for directory in sorted((d for d in directoryS if d > newest), reverse=True):
+                    if self.is_backup_directory(directory):
+                        _log.info("Found backup %r newer than history", directory)
+                        yield directory
+                seenS = set()
+                for image in itertools.chain([newest], history):
+                    if image in directoryS and image not in seenS:
+                        seenS.add(image)
+                        _log.info("Found next backup in %r", image)
+                        yield image
+            else:
+                _log.info("History file %r is missing or outdated, listing all directories", self.history_file)
+                historyS = set(history)
+                if newest is not None:
+                    historyS.add(newest)
+                for directory in sorted(directoryS | historyS, reverse=True):
+                    if directory in historyS or self.is_backup_directory(directory):
+                        _log.info("Found next backup in %r", directory)
+                        yield directory
+        finally:
+            _log.info("Saved %d directory reads", self.saved_directory_reads)
+
+    def branch_backups(self, branchL):
+        """Returns a iterator of the backup-sub-directories of all branches of branchL, newest first
+
+        The directories are listed newest first. A directory in one of the
+        history files is an image, the others are checked for the files of an
+        image. The history files are read backwards along with the listing,
+        so stopping the iteration early saves reading their older entries.
+        """
+        _log.debug(f"Finding the latest backups for vault {self.vault} - {branchL}")
+        directoryS = {name for name, entry in self.fs.entries(self.vault_base_path).items() if entry.is_dir()}
+        directoryS.discard('dirvish')
+        self.image_directories = directoryS
+        self.saved_directory_reads = len(directoryS)
+        # [newest entry not yet in historyS, rest of the history] of every branch
+        headL = []
+        for branch in branchL:
+            history = self.history(branch)
+            headL.append([next(history, None), history])
+        historyS = set()
+        try:
+            for directory in sorted(directoryS, reverse=True):
+                for head in headL:
+                    while head[0] is not None and head[0] >= directory:
+                        historyS.add(head[0])
+                        head[0] = next(head[1], None)
+                if directory in historyS or self.is_backup_directory(directory):
+                    _log.info("Found next backup in %r", directory)
+                    yield directory
+        finally:
+            _log.info("Saved %d directory reads", self.saved_directory_reads)
 
     def parse_backup(self, backup, parameterL = ['status', 'backup-begin', 'backup-complete', 'branch']):
         """ Check the last backup for validity.
@@ -134,86 +731,271 @@ class Backup(nagiosplugin.Resource):
         _log.debug("Searching for parameters %r", _parameterL)
         _resultD = dict()
         backup_image = os.path.join(self.vault_base_path, backup)
+        # checked before the cache lookup, a cached image is valid only if it would be parsed
         self.check_path_accessible(backup_image)
         self.check_path_accessible(os.path.join(backup_image, 'tree'))
         summary_file = os.path.join(backup_image, 'summary')
-        if not os.access(summary_file, os.R_OK):
+        if not self.fs.access(summary_file, os.R_OK):
             raise E_BackupNotValid('could not access summary file')
+        summary_st = None
+        if self.summary_cache is not None and set(_parameterL).issubset(SummaryCache.parameterL):
+            try:
+                summary_st = self.fs.stat(summary_file)
+            except OSError:
+                pass
+            else:
+                cachedD = self.summary_cache.get(self.vault_base_path, backup, summary_st)
+                if cachedD is not None:
+                    _resultD = {k: v for k, v in cachedD.items() if k in _parameterL}
+                    _log.info("cached Backup is: %r", _resultD)
+                    return _resultD
+                # parse all parameters to be cached
+                _parameterL = SummaryCache.parameterL
         with open(summary_file) as summary:
-            for line in summary.readlines():
-                parts = line.strip().split(': ')
-                if len(parts) >= 2:
-                    # we have a definition
-                    parameter = parts[0]
-                    value = " ".join(parts[1:])
-                    _log.debug('Found parameter %r with value %r', parameter.casefold(), value)
-                    parameter_casefold = parameter.casefold()
-                    if parameter_casefold in _parameterL:
-                        _log.debug("Adding parameter %r to returnDict", parameter_casefold)
-                        _resultD[parameter_casefold] = value
+            self.instrumentation.count('files_opened')
+            _resultD = parse_summary(summary, _parameterL)
+            self.instrumentation.count('bytes_read', summary.buffer.tell())
         _log.info("parsed Backup to: %r", _resultD)
+        if summary_st is not None:
+            # only completed images are cached, a running backup still changes its summary
+            if 'backup-complete' in _resultD:
+                self.summary_cache.put(self.vault_base_path, backup, summary_st, _resultD)
+            _parameterL = [ s.casefold() for  s in parameterL ]
+            _resultD = {k: v for k, v in _resultD.items() if k in _parameterL}
         return _resultD
 
     def check_backups(self):
-        backups = self.backups()
-        if len(backups) == 0:
-            self.valid_backup_found = 0
+        """Inspects the images newest first, until all metrics are known"""
+        if self.scan is not None:
+            self.scan.run(self)
             return
-        for backup in reversed(sorted(backups)):
+        self.start_backups()
+        for backup in self.instrumentation.timed('discovery', self.backups()):
+            self.inspected_images.append(backup)
             try:
-                parsed_backup = self.parse_backup(backup, ['status', 'backup-begin', 'backup-complete', 'branch'])
-            except E_PathNotAccessible as e:
+                with self.instrumentation.phase('summary_io'):
+                    parsed_backup = self.parse_backup(backup, ['status', 'backup-begin', 'backup-complete', 'branch'])
+            except (E_PathNotAccessible, E_BackupNotValid) as e:
+                # a broken image is not valid, look at the older ones
                 _log.debug("Exception thrown: %s", e)
                 continue
-            # ignore backup if it is the wrong branch
-            if parsed_backup.get('branch') != self.branch:
+            if self.classify(backup, parsed_backup):
+                break
+        self.finish_backups()
+        self.update_summary_cache()
+
+    def latest_successful_backup(self):
+        """Returns the newest image of the branch with a status passing status_has_errors(), or None
+
+        Only the summaries down to this image are read, and none of the
+        metrics of check_backups() are gathered.
+        """
+        for backup in self.instrumentation.timed('discovery', self.backups()):
+            try:
+                with self.instrumentation.phase('summary_io'):
+                    parsed_backup = self.parse_backup(backup, ['status', 'branch'])
+            except (E_PathNotAccessible, E_BackupNotValid) as e:
+                _log.debug("Exception thrown: %s", e)
                 continue
-            begin = dateutil.parser.parse(parsed_backup['backup-begin'])
-            _log.debug("Backup begin %r to %r", parsed_backup['backup-begin'], begin)
-            if parsed_backup.get('backup-complete') is None:
-                # backup is probably still running or was killed hard!
-                self.backup_running_now = round((datetime.datetime.now() - begin).total_seconds())
+            if parsed_backup.get('branch') != self.branch or 'status' not in parsed_backup:
                 continue
-            end = dateutil.parser.parse(parsed_backup['backup-complete'])
-            _log.debug("Backup end %r to %r", parsed_backup.get('backup-complete'), end)
-            dur = end - begin
-            _log.debug("Duration is: %s", dur)
-            if self.duration is None:
-                self.duration = round(dur.total_seconds())
-                _log.info('Gathered last duration to %s hours', dur)
-            if self.last_try is None:
-                age = datetime.datetime.now() - begin
-                self.last_try = round(age.total_seconds())
-                _log.info('Gathered last_try to %s days', age)
             if Backup.status_has_errors(parsed_backup['status']):
-                _log.debug('Valid backup found: %r', backup)
-                self.valid_backup_found = 1
-                if self.last_success is None:
-                    age = datetime.datetime.now() - begin
-                    self.last_success = round(age.total_seconds())
-                    self.last_successful_backup = backup
-                    _log.info('Gathered last_success to %s', age)
-            if self.duration and self.last_try and self.last_success:
-                _log.info('I have all required Informations. Exiting backup loop')
-                break
+                _log.info("Latest successful backup is %r", backup)
+                return backup
+        return None
 
-    def check_lockfile(self):
-        # there is a lockfile if a process
-        if os.path.exists(self.lock_file):
-            with open(self.lock_file) as f:
-                pid = f.read()
-                pid = pid.strip()
-            try:
-                pid = int(pid)
-            except ValueError:
-                self.lock_file_is_stale = True
-                return
+    def start_backups(self):
+        """Resets the metrics gathered by classify()"""
+        self.duration = None
+        self.last_try = None
+        self.last_try_status = None
+        self.last_try_image = None
+        self.last_success = None
+        self.backup_running_now = 0
+        self.valid_backup_found = 0
+        self.recent_durations = []
+        self.duration_stats = None
+        # the images parsed to gather the metrics
+        self.inspected_images = []
+
+    def classify(self, backup, parsed_backup):
+        """Gathers the metrics from the parsed summary of the image backup.
+
+        Returns True if all metrics are known, and older images need not be inspected.
+        """
+        # ignore backup if it is the wrong branch
+        if parsed_backup.get('branch') != self.branch:
+            return False
+        try:
+            with self.instrumentation.phase('date_parsing'):
+                begin = parse_timestamp(parsed_backup['backup-begin'])
+                end = None
+                if parsed_backup.get('backup-complete') is not None:
+                    end = parse_timestamp(parsed_backup['backup-complete'])
+        except (KeyError, ValueError, OverflowError) as e:
+            # a damaged summary is not valid, like a broken image
+            _log.warning("Ignoring image %r with a damaged summary: %r", backup, e)
+            return False
+        _log.debug("Backup begin %r to %r", parsed_backup['backup-begin'], begin)
+        if end is None:
+            # backup is probably still running or was killed hard!
+            self.backup_running_now = round((datetime.datetime.now() - begin).total_seconds())
+            return False
+        _log.debug("Backup end %r to %r", parsed_backup.get('backup-complete'), end)
+        dur = end - begin
+        _log.debug("Duration is: %s", dur)
+        if self.duration is None:
+            self.duration = round(dur.total_seconds())
+            _log.info('Gathered last duration to %s hours', dur)
+        if self.last_try is None:
+            age = datetime.datetime.now() - begin
+            self.last_try = round(age.total_seconds())
+            self.last_try_status = parse_status(parsed_backup.get('status', ''))
+            self.last_try_image = backup
+            _log.info('Gathered last_try to %s days, %r', age, self.last_try_status)
+        if Backup.status_has_errors(parsed_backup.get('status', '')):
+            _log.debug('Valid backup found: %r', backup)
+            self.valid_backup_found = 1
+            if self.last_success is None:
+                age = datetime.datetime.now() - begin
+                self.last_success = round(age.total_seconds())
+                self.last_successful_backup = backup
+                _log.info('Gathered last_success to %s', age)
+            # the thresholds of duration come from the earlier backups, not from the one it checks
+            if backup != self.last_try_image and len(self.recent_durations) < self.duration_history:
+                self.recent_durations.append(round(dur.total_seconds()))
+        if (self.duration is not None and self.last_try is not None and self.last_success is not None
+                and len(self.recent_durations) >= self.duration_history):
+            _log.info('I have all required Informations. Exiting backup loop')
+            return True
+        return False
+
+    def finish_backups(self):
+        """Computes the statistics of the gathered durations"""
+        if self.duration_history and len(self.recent_durations) >= self.min_duration_history:
+            self.duration_stats = duration_statistics(self.recent_durations)
+            _log.info('Statistics of the last %d durations: %r', len(self.recent_durations), self.duration_stats)
+
+    def scan_log_errors(self, backup):
+        """Returns the Counter of count_log_errors() of the log of the image backup
+
+        A compressed log is decompressed while it is read. The counts of an
+        unchanged log are taken from the summary cache.
+        """
+        for name in self.log_files:
+            log_file = os.path.join(self.vault_base_path, backup, name)
             try:
-                os.kill(pid, 0)
+                log_st = self.fs.stat(log_file)
             except OSError:
-                self.lock_file_is_stale = True
+                continue
+            break
+        else:
+            raise E_FileNotAccessible(os.path.join(self.vault_base_path, backup, 'log'))
+        if self.summary_cache is not None:
+            counter = self.summary_cache.get_log_errors(self.vault_base_path, backup, log_st)
+            if counter is not None:
+                _log.info("cached log errors are: %r", counter)
+                return counter
+        with open(log_file, 'rb') as raw:
+            self.instrumentation.count('files_opened')
+            # a truncated or damaged compressed log
+            corruptT = (EOFError,)
+            if name.endswith('.gz'):
+                import gzip, zlib
+                f = gzip.GzipFile(fileobj=raw)
+                corruptT = (EOFError, zlib.error)
+            elif name.endswith('.bz2'):
+                import bz2
+                f = bz2.BZ2File(raw)
             else:
-                self.lock_file_is_stale = False
+                f = raw
+            try:
+                counter = count_log_errors(f)
+            except corruptT as e:
+                raise E_BackupNotValid('corrupt log %r: %s' % (log_file, e))
+            self.instrumentation.count('bytes_read', raw.tell())
+        _log.info("Counted log errors of %r: %r", log_file, counter)
+        if self.summary_cache is not None:
+            self.summary_cache.put_log_errors(self.vault_base_path, backup, log_st, counter)
+            # the summary cache was committed by check_backups() already
+            self.summary_cache.commit()
+        return counter
+
+    def check_log(self):
+        """Counts the rsync errors in the log of the newest completed image"""
+        self.log_errors = self.log_error = None
+        if self.last_try_image is None:
+            return
+        with self.instrumentation.phase('log_scan'):
+            try:
+                self.log_errors = self.scan_log_errors(self.last_try_image)
+            except (OSError, E_FileNotAccessible, E_BackupNotValid) as e:
+                _log.warning("Cannot scan the log of %r: %s", self.last_try_image, e)
+                self.log_error = e
+
+    def update_summary_cache(self):
+        """Evicts the images gone from the vault and writes the summary cache"""
+        if self.summary_cache is not None:
+            self.summary_cache.evict(self.vault_base_path, self.image_directories)
+            self.summary_cache.commit()
+
+    # the name of the program holding the lock file, dirvish is run by perl
+    lock_command = 'dirvish'
+    # seconds the process may seem to have started after writing the lock file,
+    # the boot time in /proc has a resolution of seconds
+    lock_start_slack = 2
+
+    def check_lockfile(self, processes=None):
+        """Checks if the process in the lock file is a dirvish that started before writing it.
+
+        processes is a ProcessTable, by default the one of the FileSystem.
+        """
+        with self.instrumentation.phase('lockfile'):
+            self._check_lockfile(processes if processes is not None else self.fs.processes)
+
+    def is_lock_command(self, process):
+        """Checks if the executable or an argument of process is lock_command
+
+        An argument matches if its file name starts with lock_command, e.g.
+        /usr/sbin/dirvish in 'perl -w /usr/sbin/dirvish --vault v', but not
+        the text of a shell command like 'sh -c "echo dirvish"'.
+        """
+        if process.comm is not None and process.comm.startswith(self.lock_command):
+            return True
+        for arg in process.cmdline:
+            name = os.path.basename(arg)
+            if name.startswith(self.lock_command) and not any(c.isspace() for c in name):
+                return True
+        return False
+
+    def _check_lockfile(self, processes):
+        self.lock_age = None
+        try:
+            with open(self.lock_file) as f:
+                self.instrumentation.count('files_opened')
+                pid = f.read()
+                st = os.fstat(f.fileno())
+        except FileNotFoundError:
+            # there is a lockfile if a process is running
+            self.lock_file_is_stale = False
+            return
+        self.lock_age = max(round(time.time() - st.st_mtime), 0)
+        try:
+            pid = int(pid.strip())
+        except ValueError:
+            self.lock_file_is_stale = True
+            return
+        process = processes.process(pid)
+        if process is None:
+            _log.info("Process %d of the lock file is not running", pid)
+            self.lock_file_is_stale = True
+        elif process.cmdline is not None and not self.is_lock_command(process):
+            # the pid was reused, e.g. after a reboot
+            _log.info("Process %d of the lock file is not %s: %r", pid, self.lock_command, process.cmdline)
+            self.lock_file_is_stale = True
+        elif process.start_time is not None and process.start_time > st.st_mtime + self.lock_start_slack:
+            _log.info("Process %d started after the lock file was written", pid)
+            self.lock_file_is_stale = True
         else:
             self.lock_file_is_stale = False
 
@@ -226,16 +1008,7 @@ class Backup(nagiosplugin.Resource):
                   success
                   warning (24) -- file vanished on sender
         """
-        regexp = re.compile(r"""
-                    (?P<status>\w+)? \s*              # success|warning|fatal|error|unknown
-                    (\((?P<rsyncexitcode>\d+)\))? \s* # rsync exitcode
-                    (--)? \s*                         # separator
-                    (?P<description>.*)?              # description
-                 """, re.IGNORECASE|re.VERBOSE)
-        statusD = regexp.search(status).groupdict()
-        if statusD['status'] in ['success', 'warning']:
-            return True
-        return False
+        return parse_status(status).status in ('success', 'warning')
 
 
 
@@ -255,32 +1028,336 @@ class Backup(nagiosplugin.Resource):
         'last_try' is the metric for the last try
         'duraction' is the metric for the duration of the last backup
         """
-        self.duration = None
-        self.last_try = None
-        self.last_success = None
+        self.instrumentation = Instrumentation()
+        # the FileSystem may be shared, count only the calls of this vault
+        fs_counterD = collections.Counter(self.fs.counterD)
 
-        self.check_path_accessible(self.base_path)
-        self.check_path_accessible(self.vault_base_path)
-        self.check_valid_dirvish_vault()
-        self.check_backups()
-        self.check_lockfile()
+        try:
+            self.check_path_accessible(self.base_path)
+            self.check_path_accessible(self.vault_base_path)
+            self.check_valid_dirvish_vault()
+            self.check_backups()
+            self.check_lockfile()
+            if self.scan_log:
+                self.check_log()
+        finally:
+            self.instrumentation.counterD.update(self.fs.counterD - fs_counterD)
+        yield from self.metrics()
 
+    def metrics(self):
+        """Create the check metrics from the results of the last probe"""
         # the order of metrices matters which human readable output you'll get!
-        yield nagiosplugin.Metric('stale_lockfile', self.lock_file_is_stale, min=0, max=1)
+        yield self.metric('stale_lockfile', self.lock_file_is_stale, min=0, max=1)
+        if self.lock_age is not None:
+            yield self.metric('lock_age', self.lock_age, uom='s', min=0)
         _log.debug('last_success is %r seconds ago <%r>', self.last_success, type(self.last_success))
         if isinstance(self.last_success, int):
-            yield nagiosplugin.Metric('last_success', self.last_success, uom='s', min=0)
+            yield self.metric('last_success', self.last_success, uom='s', min=0)
         _log.debug('last_try is %r seconds ago, <%r>', self.last_try, type(self.last_try))
         if isinstance(self.last_try, int):
-            yield nagiosplugin.Metric('last_try', self.last_try, uom='s', min=0)
+            yield self.metric('last_try', self.last_try, uom='s', min=0)
         _log.debug('duration is instance of: %r seconds <%r>', self.duration, type(self.duration))
         if isinstance(self.duration, int):
-            yield nagiosplugin.Metric('duration', self.duration, uom='s', min=0)
+            yield self.metric('duration', self.duration, uom='s', min=0)
         _log.debug('Running backup runs for: %r seconds <%r>', self.backup_running_now, type(self.backup_running_now))
         if self.backup_running_now:
-            yield nagiosplugin.Metric('running_backup_for', self.backup_running_now, uom='s', min=0)
+            yield self.metric('running_backup_for', self.backup_running_now, uom='s', min=0)
         _log.debug('Valid Backup found: %r <%r>', self.valid_backup_found, type(self.valid_backup_found))
-        yield nagiosplugin.Metric('valid_backup_found', self.valid_backup_found, min=0, max=1)
+        yield self.metric('valid_backup_found', self.valid_backup_found, min=0, max=1)
+        if self.log_error is not None:
+            yield self.metric('log_readable', 0, min=0, max=1)
+        if self.log_errors is not None:
+            yield self.metric('log_readable', 1, min=0, max=1)
+            for error in LOG_ERRORS:
+                yield self.metric('log_%s' % error, self.log_errors[error], min=0)
+        if self.duration_stats:
+            for stat in ('median', 'p95', 'ewma'):
+                yield self.metric('duration_%s' % stat, round(self.duration_stats[stat]), uom='s', min=0)
+        if self.perf_internals:
+            yield from self.internal_metrics()
+
+    def internal_metrics(self):
+        """Metrics of the Instrumentation of the last probe"""
+        for phase, seconds in sorted(self.instrumentation.phaseD.items()):
+            # integer microseconds, perfdata of small floats would be printed in scientific notation
+            yield self.metric('internal_%s' % phase, round(seconds * 1e6), context='internals', uom='us', min=0)
+        for counter in ('directories_listed', 'stat_calls', 'access_calls', 'files_opened', 'bytes_read'):
+            yield self.metric(counter, self.instrumentation.counterD[counter], context='internals',
+                              uom='B' if counter == 'bytes_read' else '', min=0)
+
+
+class VaultScan(object):
+    """One pass over the images of a vault for the Backups of several of its branches.
+
+    Every summary is parsed once and classified by the Backup of its branch,
+    until all of them know their metrics. The Backup probed first runs the
+    scan for all of them, its Instrumentation counts the work. A VaultScan
+    is run once, create a new one for the next probe.
+    """
+
+    def __init__(self):
+        self.backupD = dict()    # branch -> Backup
+        self.lock = threading.Lock()
+        self.done = False
+        self.error = None
+
+    def add(self, backup):
+        self.backupD[backup.branch] = backup
+
+    def run(self, scanner):
+        """Classifies the images for all branches, unless that was done already"""
+        with self.lock:
+            if not self.done:
+                self.done = True
+                try:
+                    self.scan(scanner)
+                except Exception as e:
+                    self.error = e
+            if self.error is not None:
+                raise self.error
+
+    def scan(self, scanner):
+        for backup in self.backupD.values():
+            backup.start_backups()
+        pendingS = set(self.backupD)
+        for image in scanner.instrumentation.timed('discovery', scanner.branch_backups(sorted(self.backupD))):
+            try:
+                with scanner.instrumentation.phase('summary_io'):
+                    parsed_backup = scanner.parse_backup(image)
+            except (E_PathNotAccessible, E_BackupNotValid) as e:
+                # a broken image is not valid, look at the older ones
+                _log.debug("Exception thrown: %s", e)
+                continue
+            branch = parsed_backup.get('branch')
+            if branch not in pendingS:
+                continue
+            backup = self.backupD[branch]
+            backup.inspected_images.append(image)
+            if backup.classify(image, parsed_backup):
+                pendingS.discard(branch)
+                if not pendingS:
+                    break
+        for backup in self.backupD.values():
+            backup.finish_backups()
+        scanner.update_summary_cache()
+
+
+class BankBackup(Backup):
+    """A vault checked together with the other vaults of its bank.
+
+    Errors of a single vault are turned into a 'vault_accessible' metric,
+    so one broken vault does not abort the check of the whole bank.
+    """
+
+    def __init__(self, vault, base_path, branch='default', label=None, **kwargs):
+        # the name of the vault in the output, e.g. bank/vault if several banks are checked
+        self.label = label or vault
+        super().__init__(vault, base_path, branch,
+                         metric_prefix='%s_' % self.label.replace(os.sep, '_'), **kwargs)
+        self.error = None
+        # the metrics, if the vault was probed already by a ProbeEngine
+        self.metricL = None
+        # collect() is running, e.g. in a thread abandoned by the ProbeEngine
+        self.collecting = False
+
+    @classmethod
+    def for_branches(cls, vault, base_path, branchL, label=None, **kwargs):
+        """Returns a BankBackup for every branch of branchL, classified in one VaultScan"""
+        label = label or vault
+        if len(branchL) == 1:
+            return [cls(vault, base_path, branchL[0], label=label, **kwargs)]
+        scan = VaultScan()
+        return [cls(vault, base_path, branch, label='%s/%s' % (label, branch), scan=scan, **kwargs)
+                for branch in branchL]
+
+    @staticmethod
+    def find_vaults(base_path, branch='default', fs=None):
+        """Returns the sorted names of all dirvish vaults in the bank base_path
+
+        With branch None every vault with at least one branch is returned.
+        """
+        _log.debug("Find dirvish vaults in %r", base_path)
+        fs = fs if fs is not None else FileSystem()
+        vaultL = []
+        for name, entry in fs.entries(base_path).items():
+            if not entry.is_dir():
+                continue
+            if branch is None:
+                if BankBackup.find_branches(entry.path, fs):
+                    vaultL.append(name)
+            elif fs.is_file(os.path.join(entry.path, 'dirvish', f'{branch}.conf')):
+                vaultL.append(name)
+        return sorted(vaultL)
+
+    @staticmethod
+    def find_branches(vault_base_path, fs=None):
+        """Returns the sorted branches of a vault, the names of its dirvish/*.conf files"""
+        fs = fs if fs is not None else FileSystem()
+        try:
+            entryD = fs.entries(os.path.join(vault_base_path, 'dirvish'))
+        except OSError:
+            return []
+        return sorted(name[:-len('.conf')] for name, entry in entryD.items()
+                      if name.endswith('.conf') and entry.is_file())
+
+    def collect(self):
+        """Returns the list of metrics of the vault"""
+        self.collecting = True
+        try:
+            # consume the metrics here, so errors are raised before the first one is yielded
+            metricL = list(super().probe())
+        except (E_PathNotAccessible, E_PathNoDir, E_VaultIsNotDirvishDirectory,
+                E_FileNotAccessible, E_BackupNotValid,
+                OSError, KeyError, ValueError) as e:
+            # e.g. an unreadable lock file, the other vaults are checked anyway
+            _log.warning("Vault %r: %s", self.vault, e)
+            self.error = e
+            metricL = [self.metric('vault_accessible', 0, min=0, max=1)]
+        finally:
+            self.collecting = False
+        return metricL
+
+    def probe(self):
+        if self.metricL is None:
+            self.metricL = self.collect()
+        return self.metricL
+
+
+class DaemonThreadExecutor(object):
+    """Runs every call in a new daemon thread.
+
+    A call hanging on an unresponsive mount neither blocks the exit of the
+    plugin, like the workers of a ThreadPoolExecutor would, nor a worker
+    needed by another call. The caller bounds the number of calls.
+    Only submit() of concurrent.futures.Executor is implemented, which is
+    all loop.run_in_executor() uses.
+    """
+
+    def submit(self, fn, *args, **kwargs):
+        import concurrent.futures
+        future = concurrent.futures.Future()
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=run, daemon=True).start()
+        return future
+
+
+class ProbeEngine(object):
+    """Probes BankBackups concurrently, before the check evaluates them.
+
+    The blocking filesystem calls run in threads driven by asyncio, at most
+    jobs at a time and at most jobs_per_bank of them in the same bank, so
+    banks on different storage are probed in parallel without flooding one.
+    The vaults of a bank may be found by the engine as well, under the same
+    deadline. Vaults not probed and banks not listed before the deadline get
+    a 'probe_finished' metric, instead of the whole check running into the
+    timeout of nagiosplugin.
+    """
+
+    def __init__(self, jobs=4, jobs_per_bank=2):
+        self.jobs = jobs
+        self.jobs_per_bank = jobs_per_bank or jobs
+
+    async def probe_all(self, backupL, timeout=None, bankL=()):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        executor = DaemonThreadExecutor()
+        jobs = asyncio.Semaphore(self.jobs)
+        bankD = {base_path: asyncio.Semaphore(self.jobs_per_bank)
+                 for base_path in [backup.base_path for backup in backupL] + [bank[0] for bank in bankL]}
+        # index in bankL -> the BankBackups found in the bank
+        foundD = dict()
+
+        async def probe(backup):
+            async with bankD[backup.base_path], jobs:
+                backup.metricL = await loop.run_in_executor(executor, backup.collect)
+
+        async def find(i, base_path, label, find_backups):
+            async with bankD[base_path], jobs:
+                try:
+                    foundD[i] = await loop.run_in_executor(executor, find_backups)
+                except OSError as e:
+                    _log.warning("Bank %r: %s", label, e)
+                    backup = BankBackup('', base_path, label=label)
+                    backup.error = e
+                    backup.metricL = [backup.metric('vault_accessible', 0, min=0, max=1)]
+                    foundD[i] = [backup]
+                    return
+            await asyncio.gather(*map(probe, foundD[i]))
+
+        taskL = [asyncio.ensure_future(probe(backup)) for backup in backupL]
+        taskL.extend(asyncio.ensure_future(find(i, *bank)) for i, bank in enumerate(bankL))
+        done, pending = await asyncio.wait(taskL, timeout=timeout)
+        resultL = list(backupL)
+        for i, (base_path, label, find_backups) in enumerate(bankL):
+            if i not in foundD:
+                _log.warning("Bank %r: vaults not found within %.1fs", label, timeout)
+                backup = BankBackup('', base_path, label=label)
+                backup.metricL = [backup.metric('probe_finished', 0, min=0, max=1)]
+                foundD[i] = [backup]
+            resultL.extend(foundD[i])
+        for task in pending:
+            # a running probe can not be stopped, its thread is abandoned
+            task.cancel()
+        for backup in resultL:
+            if backup.metricL is None:
+                _log.warning("Vault %r: probe did not finish within %.1fs", backup.label, timeout)
+                backup.metricL = [backup.metric('probe_finished', 0, min=0, max=1)]
+        # errors not caught by BankBackup.collect() abort the check
+        errorL = [task.exception() for task in done if task.exception() is not None]
+        if errorL:
+            raise errorL[0]
+        return resultL
+
+    def run(self, backupL, timeout=None, bankL=()):
+        """Probes backupL, giving up on the vaults not done after timeout seconds
+
+        bankL is a list of (base_path, label, find_backups) of banks whose
+        vaults are found by the engine: find_backups() returns the
+        BankBackups of the bank. Returns backupL and the BankBackups found,
+        a bank not listed in time is a single BankBackup labeled label.
+        """
+        import asyncio
+        return asyncio.run(self.probe_all(backupL, timeout, bankL))
+
+
+class BankSummary(nagiosplugin.Summary):
+    """Status line and per-vault long output for a check of several vaults"""
+
+    @staticmethod
+    def vault_states(results):
+        """Returns a dict of vault name to the worst result of that vault"""
+        vaultD = dict()
+        for result in results:
+            vault = result.resource.label
+            if vault not in vaultD or result.state > vaultD[vault].state:
+                vaultD[vault] = result
+        return vaultD
+
+    @staticmethod
+    def vaults(results):
+        """Returns the set of (bank, vault) of results, the branches of a vault count once"""
+        return {(result.resource.base_path, result.resource.vault) for result in results}
+
+    def ok(self, results):
+        return "%d vaults OK" % len(self.vaults(results))
+
+    def problem(self, results):
+        vaultD = self.vault_states(results)
+        problemL = [v for v, r in vaultD.items() if r.state != nagiosplugin.state.Ok]
+        return "%d of %d vaults not OK (%s): %s" % (
+            len(self.vaults(r for r in vaultD.values() if r.state != nagiosplugin.state.Ok)),
+            len(self.vaults(results)), ", ".join(problemL), results.first_significant)
+
+    def verbose(self, results):
+        return ["%s: %s" % (r.state, r) for r in self.vault_states(results).values()]
 
 
 class Duration_Fmt_Metric(object):
@@ -338,7 +1415,17 @@ class Duration_Fmt_Metric(object):
         valueunit = self.seconds_human_readable(int(metric.value))
         return self.fmt_string.format(
             name=metric.name, value=metric.value, uom=metric.uom,
-            valueunit=valueunit, min=metric.min, max=metric.max)
+            valueunit=valueunit, min=metric.min, max=metric.max,
+            resource=metric.resource)
+
+class Count_Fmt_Metric(object):
+    """print a message for a metric counting something"""
+
+    def __init__(self, fmt_string):
+        self.fmt_string = fmt_string
+
+    def __call__(self, metric, context):
+        return self.fmt_string.format(value=metric.value, resource=metric.resource)
 
 class Bool_Fmt_Metric(object):
     """print a message for a bool-metric  """
@@ -349,27 +1436,136 @@ class Bool_Fmt_Metric(object):
 
     def __call__(self, metric, context):
         if context.evaluate(metric, metric.resource) == nagiosplugin.state.Ok:
-            return self.msg_success
+            return self.msg_success.format(resource=metric.resource)
         else:
-            return self.msg_fail
+            return self.msg_fail.format(resource=metric.resource)
 
 
 class BoolContext(nagiosplugin.context.Context):
     """ Nagios Context describing when a bool is ok or critical """
 
-    def __init__(self, name, critical=True, fmt_metric=None, result_cls=nagiosplugin.Result):
+    def __init__(self, name, critical=True, fmt_metric=None, result_cls=nagiosplugin.Result,
+                 state=nagiosplugin.state.Critical):
         super().__init__(name, fmt_metric, result_cls)
         self.critical = critical
+        # the state if the value is critical
+        self.state = state
 
     def evaluate(self, metric, resource):
         if metric.value == self.critical:
-            return nagiosplugin.state.Critical
+            return self.state
         else:
             return nagiosplugin.state.Ok
 
 
-@nagiosplugin.guarded
-def main():
+class AdaptiveDurationContext(nagiosplugin.ScalarContext):
+    """ ScalarContext for durations, that derives the thresholds from the
+        duration_stats of the resource if it has them:
+        warning is the larger of p95 and ewma times warning_factor,
+        critical is the same times critical_factor.
+        Without duration_stats the fixed thresholds are used.
+    """
+
+    def __init__(self, name, warning=None, critical=None, fmt_metric=None,
+                 warning_factor=None, critical_factor=None):
+        super().__init__(name, warning, critical, fmt_metric)
+        self.warning_factor = warning_factor
+        self.critical_factor = critical_factor
+
+    def ranges(self, resource):
+        stats = getattr(resource, 'duration_stats', None)
+        if not stats or self.warning_factor is None:
+            return self.warning, self.critical
+        expected = max(stats['p95'], stats['ewma'])
+        warning = nagiosplugin.Range(round(expected * self.warning_factor))
+        critical = self.critical
+        if self.critical_factor is not None:
+            critical = nagiosplugin.Range(round(expected * self.critical_factor))
+        return warning, critical
+
+    def evaluate(self, metric, resource):
+        warning, critical = self.ranges(resource)
+        if not critical.match(metric.value):
+            return self.result_cls(nagiosplugin.Critical, critical.violation, metric)
+        if not warning.match(metric.value):
+            return self.result_cls(nagiosplugin.Warn, warning.violation, metric)
+        return self.result_cls(nagiosplugin.Ok, None, metric)
+
+    def performance(self, metric, resource):
+        warning, critical = self.ranges(resource)
+        return nagiosplugin.Performance(metric.name, metric.value, metric.uom,
+                                        warning, critical, metric.min, metric.max)
+
+
+def contexts(args, fmt_prefix=''):
+    """Returns the contexts evaluating the metrics of Backup.probe()
+
+    fmt_prefix is put in front of every human readable message,
+    e.g. '{resource.label}: ' to name the vault in a check of several vaults.
+    """
+    try:
+        running_critical = int(args.max_duration) * 3
+    except ValueError:
+        # a range can not be multiplied
+        running_critical = None
+    warning_factor = critical_factor = None
+    if getattr(args, 'adaptive_duration', 0):
+        warning_factor, critical_factor = (float(f) for f in args.adaptive_factors.split(','))
+    log_errors = getattr(args, 'log_errors', None)
+    return [
+        BoolContext( name = 'stale_lockfile',
+                     critical = True,
+                     fmt_metric = Bool_Fmt_Metric(fmt_prefix + 'LockFile is OK!', fmt_prefix + 'LockFile is stale!')),
+        BoolContext( 'valid_backup_found',
+                     critical=False,
+                     fmt_metric = Bool_Fmt_Metric(fmt_prefix + 'Valid backup found!', fmt_prefix + 'No valid Backup found!')),
+        BoolContext( 'vault_accessible',
+                     critical=False,
+                     fmt_metric = Bool_Fmt_Metric(fmt_prefix + 'Vault is accessible!', fmt_prefix + '{resource.error}')),
+        BoolContext( 'probe_finished',
+                     critical=False,
+                     fmt_metric = Bool_Fmt_Metric(fmt_prefix + 'Probe finished!', fmt_prefix + 'Probe did not finish in time'),
+                     state = nagiosplugin.state.Unknown),
+        nagiosplugin.ScalarContext( 'lock_age',
+                                    fmt_metric = Duration_Fmt_Metric(fmt_prefix + 'LockFile is {valueunit} old')),
+        nagiosplugin.ScalarContext( 'last_success', args.warning, args.critical,
+                                    Duration_Fmt_Metric(fmt_prefix + 'Last successful backup is {valueunit} old')),
+        nagiosplugin.ScalarContext( 'last_try', args.warning, args.critical,
+                                    Duration_Fmt_Metric(fmt_prefix + 'Last backup tried {valueunit} ago')),
+        AdaptiveDurationContext( name = 'duration',
+                                 warning = args.max_duration,
+                                 fmt_metric = Duration_Fmt_Metric(fmt_prefix + 'Last backuprun took {valueunit}'),
+                                 warning_factor = warning_factor),
+        AdaptiveDurationContext( name = 'running_backup_for',
+                                 warning = args.max_duration,
+                                 critical = running_critical,
+                                 fmt_metric = Duration_Fmt_Metric(fmt_prefix + 'Running backup since {valueunit}'),
+                                 warning_factor = warning_factor,
+                                 critical_factor = critical_factor),
+        nagiosplugin.ScalarContext( 'duration_median',
+                                    fmt_metric = Duration_Fmt_Metric(fmt_prefix + 'Median backuprun took {valueunit}')),
+        nagiosplugin.ScalarContext( 'duration_p95',
+                                    fmt_metric = Duration_Fmt_Metric(fmt_prefix + '95% of the backupruns took less than {valueunit}')),
+        nagiosplugin.ScalarContext( 'duration_ewma',
+                                    fmt_metric = Duration_Fmt_Metric(fmt_prefix + 'Average backuprun takes {valueunit}')),
+        BoolContext( 'log_readable',
+                     critical=False,
+                     fmt_metric = Bool_Fmt_Metric(fmt_prefix + 'Log is readable!',
+                                                  fmt_prefix + 'Log of the last backup is not readable: {resource.log_error}'),
+                     state = nagiosplugin.state.Warn),
+        nagiosplugin.ScalarContext( 'log_vanished_files',
+                                    fmt_metric = Count_Fmt_Metric(fmt_prefix + '{value} files vanished during the last backup')),
+        nagiosplugin.ScalarContext( 'log_permission_denied', log_errors,
+                                    fmt_metric = Count_Fmt_Metric(fmt_prefix + '{value} files not readable (permission denied) in the last backup')),
+        nagiosplugin.ScalarContext( 'log_io_errors', log_errors,
+                                    fmt_metric = Count_Fmt_Metric(fmt_prefix + '{value} I/O errors in the last backup')),
+        nagiosplugin.ScalarContext( 'internals'),
+    ]
+
+
+def argument_parser():
+    """Returns the ArgumentParser with the options evaluated by contexts()"""
+    import argparse
     argp = argparse.ArgumentParser()
     argp.add_argument('-w', '--warning', metavar='RANGE',
                       help='warning if backup age is outside RANGE in seconds'),
@@ -385,28 +1581,163 @@ def main():
                       help="max time to take a backup in seconds (3600)")
     argp.add_argument('--branch', default="default",
                       help="Branch to check (default)")
-    argp.add_argument('vault', help='Name of the vault to check')
+    argp.add_argument('--adaptive-duration', type=int, default=0, metavar='N',
+                      help="derive the duration thresholds from the last N successful backups "
+                           "instead of --max-duration (0: off)")
+    argp.add_argument('--adaptive-factors', default='1.5,3', metavar='WARNING,CRITICAL',
+                      help="thresholds are these factors times the larger of the 95th percentile "
+                           "and the moving average of the durations (1.5,3)")
+    return argp
+
+
+def write_textfile(filename, text):
+    """Replaces filename atomically, so a reader never sees a partial file"""
+    import tempfile
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename) or '.', prefix='.%s_' % os.path.basename(filename))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, filename)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def write_trace(filename, check, probe_start):
+    """Appends the Instrumentation of the resources of check as one json line to filename"""
+    end = time.perf_counter()
+    vaultD = {getattr(resource, 'label', resource.vault): resource.instrumentation.as_dict()
+              for resource in check.resources if isinstance(resource, Backup)}
+    probed = sum(sum(v['phases'].values()) for v in vaultD.values())
+    trace = {
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'startup': probe_start - _start_time,
+        'total': end - _start_time,
+        # evaluating the contexts, formatting the output and the time outside of the phases
+        'overhead': end - probe_start - probed,
+        'vaults': vaultD,
+    }
+    try:
+        with open(filename, 'a') as f:
+            f.write(json.dumps(trace, sort_keys=True) + '\n')
+    except OSError as e:
+        _log.warning("Cannot write trace %r: %s", filename, e)
+
+
+def bank_labels(base_pathL):
+    """Returns a dict of base path to the last parts of the path, as many as tell the banks apart
+
+    e.g. /mnt/a1/dirvish and /mnt/a2/dirvish are labeled a1/dirvish and a2/dirvish.
+    """
+    partD = {base_path: [part for part in os.path.normpath(os.path.abspath(base_path)).split(os.sep) if part]
+             for base_path in base_pathL}
+    depth = 1
+    while True:
+        labelD = {base_path: os.path.join(*partL[-depth:]) if partL[-depth:] else os.sep
+                  for base_path, partL in partD.items()}
+        if (len(set(labelD.values())) == len(set(map(tuple, partD.values())))
+                or depth >= max(map(len, partD.values()))):
+            return labelD
+        depth += 1
+
+
+@nagiosplugin.guarded
+def main():
+    argp = argument_parser()
+    argp.add_argument('--summary-cache', metavar='FILE',
+                      help="sqlite file to cache the parsed summaries of completed backups in")
+    argp.add_argument('--all-vaults', action='store_true',
+                      help="check every dirvish vault found in the bank")
+    argp.add_argument('--perf-internals', action='store_true',
+                      help="add the time of the phases and the filesystem calls of the check to the perfdata")
+    argp.add_argument('--trace', metavar='FILE',
+                      help="append the time of the phases and the filesystem calls of the check as json line to FILE")
+    argp.add_argument('--bank', action='append', default=[], metavar='BASE_PATH',
+                      help="check every dirvish vault found in this bank too, can be given several times")
+    argp.add_argument('--jobs', type=int, default=4,
+                      help="number of vaults probed concurrently (%(default)s)")
+    argp.add_argument('--jobs-per-bank', type=int, default=2,
+                      help="number of vaults of the same bank probed concurrently (%(default)s)")
+    argp.add_argument('--branches', metavar='BRANCH,...',
+                      help="check these branches instead of --branch, in one pass over the images of a vault. "
+                           "'all' checks every branch with a dirvish/BRANCH.conf")
+    argp.add_argument('--scan-log', action='store_true',
+                      help="count vanished files, permission denied and I/O errors in the (compressed) log "
+                           "of the newest backup, cached in --summary-cache")
+    argp.add_argument('--log-errors', metavar='RANGE',
+                      help="warning if the permission denied or I/O errors of --scan-log are outside RANGE")
+    argp.add_argument('vault', nargs='*',
+                      help='Name of the vault to check. Several vaults are checked together in one run')
     args = argp.parse_args()
-    check = nagiosplugin.Check(
-        Backup(args.vault, args.base_path, args.branch),
-        BoolContext( name = 'stale_lockfile',
-                     critical = True,
-                     fmt_metric = Bool_Fmt_Metric('LockFile is OK!', 'LockFile is stale!')),
-        BoolContext( 'valid_backup_found',
-                     critical=False,
-                     fmt_metric = Bool_Fmt_Metric('Valid backup found!', 'No valid Backup found!')),
-        nagiosplugin.ScalarContext( 'last_success', args.warning, args.critical,
-                                    Duration_Fmt_Metric('Last successful backup is {valueunit} old')),
-        nagiosplugin.ScalarContext( 'last_try', args.warning, args.critical,
-                                    Duration_Fmt_Metric('Last backup tried {valueunit} ago')),
-        nagiosplugin.ScalarContext( name = 'duration',
-                                    warning = args.max_duration,
-                                    fmt_metric = Duration_Fmt_Metric('Last backuprun took {valueunit}')),
-        nagiosplugin.ScalarContext( name = 'running_backup_for',
-                                    warning = args.max_duration,
-                                    critical = args.max_duration*3,
-                                    fmt_metric = Duration_Fmt_Metric('Running backup since {valueunit}')),
-    )
+    probe_start = time.perf_counter()
+    # the banks are probed before check.main() sets the verbosity of the log
+    nagiosplugin.Runtime().verbose = args.verbose
+    # all vaults of this run share the listings of the banks
+    fs = FileSystem()
+
+    def branches(base_path, vault):
+        if args.branches is None:
+            return [args.branch]
+        if args.branches == 'all':
+            # a vault without branches is reported as not a dirvish vault
+            return BankBackup.find_branches(os.path.join(base_path, vault), fs) or [args.branch]
+        return args.branches.split(',')
+
+    # with --branches a vault needs not have the branch --branch
+    find_branch = None if args.branches else args.branch
+    bankL = []      # [(base_path, vaultL or None to find the vaults of the bank)]
+    if args.all_vaults:
+        if args.vault:
+            argp.error('--all-vaults does not take vault names')
+        bankL.append((args.base_path, None))
+    elif args.vault:
+        bankL.append((args.base_path, args.vault))
+    elif not args.bank:
+        argp.error('the name of a vault, --all-vaults or --bank is required')
+    for base_path in args.bank:
+        bankL.append((base_path, None))
+    summary_cache = SummaryCache(args.summary_cache) if args.summary_cache else None
+    if (len(bankL) == 1 and bankL[0][1] is not None and len(bankL[0][1]) == 1
+            and args.branches is None):
+        check = nagiosplugin.Check(
+            Backup(bankL[0][1][0], args.base_path, args.branch, summary_cache=summary_cache,
+                   duration_history=args.adaptive_duration, fs=fs, perf_internals=args.perf_internals,
+                   scan_log=args.scan_log),
+            *contexts(args))
+    else:
+        bank_labelD = bank_labels([base_path for base_path, vaultL in bankL])
+
+        def find_backups(base_path, vaultL):
+            # runs in the ProbeEngine, a hanging bank does not hold up the others
+            if vaultL is None:
+                vaultL = BankBackup.find_vaults(base_path, find_branch, fs)
+            backupL = []
+            for vault in vaultL:
+                # vaults of different banks may have the same name
+                label = vault if len(bankL) == 1 else os.path.join(bank_labelD[base_path], vault)
+                backupL.extend(BankBackup.for_branches(vault, base_path, branches(base_path, vault), label=label,
+                                                       summary_cache=summary_cache,
+                                                       duration_history=args.adaptive_duration, fs=fs,
+                                                       perf_internals=args.perf_internals,
+                                                       scan_log=args.scan_log))
+            return backupL
+
+        timeout = None
+        if float(args.timeout) > 0:
+            # leave some of the timeout to evaluate the vaults probed in time
+            timeout = max(float(args.timeout) * 0.9 - (time.perf_counter() - probe_start), 0)
+        backupL = ProbeEngine(args.jobs, args.jobs_per_bank).run(
+            [], timeout, [(base_path, bank_labelD[base_path], functools.partial(find_backups, base_path, vaultL))
+                          for base_path, vaultL in bankL])
+        check = nagiosplugin.Check(
+            *backupL,
+            *contexts(args, '{resource.label}: '),
+            BankSummary(),
+            name='Bank %s' % ', '.join(base_path for base_path, vaultL in bankL))
+    if args.trace:
+        # check.main() exits, so the trace is written on exit
+        atexit.register(write_trace, args.trace, check, probe_start)
     check.main(args.verbose, args.timeout)
 
 if __name__ == '__main__':
@@ -0,0 +1,354 @@
+#! /usr/bin/python3
+
+"""
+Daemon keeping the status of dirvish vaults in memory, and a thin nagios
+plugin querying it over a unix socket.
+
+The daemon probes a vault on the first query and watches the vault, its
+dirvish directory and the inspected images via inotify (or by comparing
+mtimes, if inotify is not available). Later queries are answered from memory
+until something changed.
+
+    ./check_dirvish_daemon.py --serve --base-path /srv/backup
+    ./check_dirvish_daemon.py -w 90000 -c 180000 vault
+"""
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+import socket
+import socketserver
+import stat
+import struct
+import time
+
+import check_dirvish
+import nagiosplugin
+
+_log = logging.getLogger('nagiosplugin')
+
+DEFAULT_SOCKET = '/run/check_dirvish.sock'
+
+
+class InotifyWatcher(object):
+    """Marks keys as dirty if one of their watched directories changes"""
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+            IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+    # struct inotify_event without the name
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.wdD = dict()      # watch descriptor -> set of keys
+        self.keyD = dict()     # key -> set of watch descriptors
+        self.dirtyS = set()
+
+    def watch(self, key, pathL):
+        self.forget(key)
+        wdS = set()
+        for path in pathL:
+            if not os.path.isdir(path):
+                # files are watched by their directory
+                continue
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.MASK)
+            if wd < 0:
+                _log.warning("Cannot watch %r: %s", path, os.strerror(ctypes.get_errno()))
+                continue
+            wdS.add(wd)
+            self.wdD.setdefault(wd, set()).add(key)
+        self.keyD[key] = wdS
+        self.dirtyS.discard(key)
+
+    def forget(self, key):
+        for wd in self.keyD.pop(key, ()):
+            keyS = self.wdD.get(wd, set())
+            keyS.discard(key)
+            if not keyS:
+                self.wdD.pop(wd, None)
+                self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(buf):
+                wd, mask, _, length = self.EVENT.unpack_from(buf, offset)
+                offset += self.EVENT.size + length
+                if mask & self.IN_Q_OVERFLOW:
+                    _log.warning("inotify queue overflowed, invalidating all vaults")
+                    self.dirtyS.update(self.keyD)
+                    continue
+                self.dirtyS.update(self.wdD.get(wd, ()))
+                if mask & self.IN_IGNORED:
+                    # the directory is gone, the kernel removed the watch
+                    for key in self.wdD.pop(wd, ()):
+                        self.keyD[key].discard(wd)
+
+    def is_dirty(self, key):
+        self.read_events()
+        return key in self.dirtyS
+
+
+class PollingWatcher(object):
+    """Marks keys as dirty if the mtime or size of one of their paths changed"""
+
+    @staticmethod
+    def signature(pathL):
+        signatureL = []
+        for path in pathL:
+            try:
+                st = os.stat(path)
+                signatureL.append((st.st_ino, st.st_mtime_ns, st.st_size))
+            except OSError:
+                signatureL.append(None)
+        return signatureL
+
+    def __init__(self):
+        self.keyD = dict()     # key -> (pathL, signature)
+
+    def watch(self, key, pathL):
+        self.keyD[key] = (pathL, self.signature(pathL))
+
+    def forget(self, key):
+        self.keyD.pop(key, None)
+
+    def is_dirty(self, key):
+        pathL, signature = self.keyD[key]
+        return self.signature(pathL) != signature
+
+
+def watcher():
+    """Returns a InotifyWatcher, or a PollingWatcher if inotify is not available"""
+    try:
+        return InotifyWatcher()
+    except (OSError, AttributeError, TypeError) as e:
+        _log.warning("inotify is not available (%s), polling instead", e)
+        return PollingWatcher()
+
+
+class VaultStatus(object):
+    """Metrics of the vaults in a bank, kept up to date by a watcher"""
+
+    def __init__(self, base_path, watcher, max_age=3600, summary_cache=None):
+        self.base_path = base_path
+        self.watcher = watcher
+        # seconds after which a vault is probed again, even without changes
+        self.max_age = max_age
+        self.summary_cache = summary_cache
+        self.entryD = dict()
+
+    def refresh(self, vault, branch, duration_history=0):
+        _log.info("Probing vault %r - %r", vault, branch)
+        backup = check_dirvish.Backup(vault, self.base_path, branch, summary_cache=self.summary_cache,
+                                      duration_history=duration_history)
+        entry = {'backup': backup, 'time': time.time(), 'metrics': None, 'error': None}
+        try:
+            entry['metrics'] = [metric._asdict() for metric in backup.probe()]
+        except (check_dirvish.E_PathNotAccessible, check_dirvish.E_PathNoDir,
+                check_dirvish.E_VaultIsNotDirvishDirectory, check_dirvish.E_FileNotAccessible,
+                check_dirvish.E_BackupNotValid) as e:
+            entry['error'] = {'class': e.__class__.__name__, 'value': e.value}
+        dirvish_dir = os.path.join(backup.vault_base_path, 'dirvish')
+        pathL = [self.base_path, backup.vault_base_path, dirvish_dir,
+                 os.path.join(dirvish_dir, f'{branch}.hist'), os.path.join(dirvish_dir, 'lock_file')]
+        for image in getattr(backup, 'inspected_images', []):
+            pathL.append(os.path.join(backup.vault_base_path, image))
+            pathL.append(os.path.join(backup.vault_base_path, image, 'summary'))
+        self.watcher.watch((vault, branch, duration_history), pathL)
+        self.entryD[(vault, branch, duration_history)] = entry
+        return entry
+
+    def status(self, vault, branch='default', duration_history=0):
+        """Returns a dict with the 'metrics' of vault or the 'error' probing it"""
+        key = (vault, branch, duration_history)
+        entry = self.entryD.get(key)
+        if (entry is None or self.watcher.is_dirty(key)
+                or time.time() - entry['time'] > self.max_age):
+            entry = self.refresh(vault, branch, duration_history)
+        if entry['error'] is not None:
+            return {'error': entry['error']}
+        # the lock file can get stale without any change on disk
+        backup = entry['backup']
+        backup.check_lockfile(check_dirvish.ProcessTable())
+        elapsed = round(time.time() - entry['time'])
+        metricL = []
+        for metricD in entry['metrics']:
+            metricD = dict(metricD, contextobj=None, resource=None)
+            if metricD['context'] == 'stale_lockfile':
+                metricD['value'] = backup.lock_file_is_stale
+            elif metricD['context'] in check_dirvish.AGE_METRICS:
+                metricD['value'] += elapsed
+            metricL.append(metricD)
+        return {'metrics': metricL}
+
+
+class StatusRequestHandler(socketserver.StreamRequestHandler):
+    """Answers one json line {"vault": ..., "branch": ..., "base_path": ..., "duration_history": ...}
+       with one json line"""
+
+    # the requests are answered one after the other, a client not sending its
+    # request must not block the others
+    timeout = 10
+
+    def handle(self):
+        try:
+            line = self.rfile.readline()
+        except OSError as e:
+            _log.warning("Cannot read request: %s", e)
+            return
+        try:
+            request = json.loads(line)
+            vault = request['vault']
+            # a vault is a directory in the bank, not a path leading out of it
+            if vault in ('', os.curdir, os.pardir) or os.sep in vault or (os.altsep and os.altsep in vault):
+                raise ValueError('invalid vault %r' % vault)
+            base_path = request.get('base_path', self.server.vault_status.base_path)
+            if os.path.normpath(base_path) != os.path.normpath(self.server.vault_status.base_path):
+                raise ValueError('daemon serves %r, not %r' % (self.server.vault_status.base_path, base_path))
+            response = self.server.vault_status.status(vault, request.get('branch', 'default'),
+                                                       int(request.get('duration_history', 0)))
+        except Exception as e:
+            _log.exception("Cannot answer request")
+            response = {'error': {'class': e.__class__.__name__, 'value': str(e)}}
+        self.wfile.write(json.dumps(response).encode() + b'\n')
+
+
+def serve(socket_path, vault_status, mode=0o660, group=None):
+    """Answers the queries on socket_path, which is created with mode and group"""
+    try:
+        mode = os.lstat(socket_path).st_mode
+    except FileNotFoundError:
+        pass
+    else:
+        # the socket of a former daemon, any other file is left alone
+        if not stat.S_ISSOCK(mode):
+            raise FileExistsError('%r exists and is not a socket' % socket_path)
+        os.unlink(socket_path)
+    with socketserver.UnixStreamServer(socket_path, StatusRequestHandler) as server:
+        # the clients need write permission to connect
+        os.chmod(socket_path, mode)
+        if group is not None:
+            os.chown(socket_path, -1, group)
+        server.vault_status = vault_status
+        _log.info("Serving vault status of %r on %r", vault_status.base_path, socket_path)
+        server.serve_forever()
+
+
+class DaemonBackup(check_dirvish.Backup):
+    """Backup probed by the daemon listening on socket_path.
+
+    If the daemon is not reachable or does not answer within timeout seconds,
+    the vault is probed directly.
+    """
+
+    def __init__(self, vault, base_path, branch='default', socket_path=DEFAULT_SOCKET, duration_history=0,
+                 timeout=None):
+        super().__init__(vault, base_path, branch, duration_history=duration_history)
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    @property
+    def name(self):
+        """same name as a directly probed Backup"""
+        return "Backup %s" % self.vault.split('.')[0]
+
+    def query(self):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            sock.sendall(json.dumps({'vault': self.vault, 'branch': self.branch,
+                                     'base_path': self.base_path,
+                                     'duration_history': self.duration_history}).encode() + b'\n')
+            with sock.makefile('rb') as f:
+                return json.loads(f.readline())
+
+    def probe(self):
+        try:
+            response = self.query()
+        except (OSError, ValueError) as e:
+            _log.warning("Daemon on %r is not reachable (%s), probing directly", self.socket_path, e)
+            yield from super().probe()
+            return
+        if 'error' in response:
+            error_cls = getattr(check_dirvish, response['error']['class'], None)
+            if error_cls is None or not issubclass(error_cls, Exception):
+                raise nagiosplugin.CheckError(response['error']['value'])
+            raise error_cls(response['error']['value'])
+        metricL = [nagiosplugin.Metric(**metricD) for metricD in response['metrics']]
+        # the adaptive duration thresholds are derived from these
+        statD = {m.context[len('duration_'):]: m.value for m in metricL
+                 if m.context in ('duration_median', 'duration_p95', 'duration_ewma')}
+        self.duration_stats = statD or None
+        yield from metricL
+
+
+@nagiosplugin.guarded
+def check(args):
+    # leave half of the timeout to probe the vault directly, if the daemon does not answer
+    check = nagiosplugin.Check(
+        DaemonBackup(args.vault, args.base_path, args.branch, args.socket, args.adaptive_duration,
+                     float(args.timeout) / 2 or None),
+        *check_dirvish.contexts(args))
+    check.main(args.verbose, args.timeout)
+
+def main():
+    argp = check_dirvish.argument_parser()
+    argp.add_argument('--socket', default=DEFAULT_SOCKET,
+                      help="unix socket of the daemon (%(default)s)")
+    argp.add_argument('--socket-mode', type=lambda mode: int(mode, 8), default=0o660, metavar='MODE',
+                      help="octal permissions of the socket created by --serve (660)")
+    argp.add_argument('--socket-group', metavar='GROUP',
+                      help="group of the socket created by --serve, e.g. the group nagios runs in")
+    argp.add_argument('--serve', action='store_true',
+                      help="run the daemon serving the vaults in BASE_PATH")
+    argp.add_argument('--max-age', type=int, default=3600,
+                      help="probe a vault again after MAX_AGE seconds without changes (%(default)s)")
+    argp.add_argument('--polling', action='store_true',
+                      help="compare mtimes instead of using inotify, e.g. for banks on NFS")
+    argp.add_argument('--summary-cache', metavar='FILE',
+                      help="sqlite file to cache the parsed summaries of completed backups in")
+    argp.add_argument('vault', nargs='?', help='Name of the vault to check')
+    args = argp.parse_args()
+    if args.serve:
+        logging.basicConfig(level=[logging.WARNING, logging.INFO, logging.DEBUG][min(args.verbose, 2)])
+        summary_cache = check_dirvish.SummaryCache(args.summary_cache) if args.summary_cache else None
+        vault_status = VaultStatus(args.base_path, PollingWatcher() if args.polling else watcher(),
+                                   args.max_age, summary_cache)
+        group = None
+        if args.socket_group is not None:
+            import grp
+            try:
+                group = grp.getgrnam(args.socket_group).gr_gid
+            except KeyError:
+                argp.error('unknown group %r' % args.socket_group)
+        try:
+            serve(args.socket, vault_status, args.socket_mode, group)
+        except FileExistsError as e:
+            argp.error(str(e))
+    elif args.vault:
+        check(args)
+    else:
+        argp.error('the name of a vault or --serve is required')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,344 @@
+#! /usr/bin/python3
+
+"""
+Audit of the integrity of all retained images of dirvish banks.
+
+Every image needs a readable summary and log and a non-empty tree, and the
+history files (dirvish/<branch>.hist) have to agree with the images on disk:
+
+    orphaned   a directory of the vault that is in no history file
+    missing    a history entry newer than the newest image of its branch on
+               disk, the older ones are counted as expired
+    corrupt    an image with an unreadable or incomplete summary or log, or
+               a missing or empty tree
+
+An incomplete image is the backup running now, and not reported, if it is
+the newest image of its branch and a dirvish process holds the lock file.
+
+The vaults are audited by --workers processes. Every audited vault is
+written to the --state file, so an audit stopped by --timeout or an
+interrupt is resumed by the next run, after a finished audit the next run
+starts anew. --max-ops and --max-bytes limit the filesystem
+operations and bytes read per second of all workers together.
+
+    ./dirvish_audit.py --base-path /srv/backup --workers 2 --max-ops 500 --timeout 3600
+
+The exit code is 0 if the audit is complete and found nothing, 1 if it found
+problems and 2 if it is not complete yet.
+"""
+import argparse
+import bz2
+import contextlib
+import gzip
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+import check_dirvish
+
+_log = logging.getLogger('nagiosplugin')
+
+STATE_VERSION = 1
+
+# names of the log file of an image, dirvish compresses it with log-compress
+LOG_OPENERS = {'log': open, 'log.gz': gzip.open, 'log.bz2': bz2.open}
+
+# problems listed per vault and kind in the text report, the json report has all
+REPORT_IMAGES = 5
+
+
+class Throttle(object):
+    """Limits an operation to rate per second, on average since the creation of the Throttle"""
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.start = time.monotonic()
+        self.done = 0
+
+    def wait(self, n=1):
+        if not self.rate:
+            return
+        self.done += n
+        delay = self.done / self.rate - (time.monotonic() - self.start)
+        if delay > 0:
+            time.sleep(delay)
+
+
+class VaultAudit(object):
+    """The audit of the images of one vault, run in a worker process"""
+
+    def __init__(self, base_path, vault, max_ops=None, max_bytes=None):
+        self.base_path = base_path
+        self.vault = vault
+        self.vault_base_path = os.path.join(base_path, vault)
+        self.ops = Throttle(max_ops)
+        self.bytes = Throttle(max_bytes)
+
+    def listdir(self, directory):
+        self.ops.wait()
+        with os.scandir(directory) as it:
+            return {entry.name: entry for entry in it}
+
+    def read(self, filename, opener=open, blocksize=65536, limit=None):
+        """Returns the content of filename as bytes, at most limit bytes, raises OSError"""
+        self.ops.wait()
+        blockL = []
+        size = 0
+        with opener(filename, 'rb') as f:
+            while limit is None or size < limit:
+                block = f.read(blocksize)
+                if not block:
+                    break
+                self.bytes.wait(len(block))
+                blockL.append(block)
+                size += len(block)
+        return b''.join(blockL)
+
+    def histories(self):
+        """Returns a dict of branch to the list of images of its history file, oldest first"""
+        historyD = {}
+        for name, entry in sorted(self.listdir(os.path.join(self.vault_base_path, 'dirvish')).items()):
+            if not name.endswith('.hist') or not entry.is_file():
+                continue
+            lineL = self.read(entry.path).decode(errors='replace').splitlines()
+            # the first line is the header of the table
+            historyD[name[:-len('.hist')]] = [image for image in
+                                              (line.strip().split('\t')[0] for line in lineL[1:]) if image]
+        return historyD
+
+    def check_image(self, image):
+        """Returns the parsed summary of image and the reason it is corrupt or None"""
+        image_dir = os.path.join(self.vault_base_path, image)
+        try:
+            entryD = self.listdir(image_dir)
+        except OSError as e:
+            return {}, 'cannot list image: %s' % e.strerror
+        summaryD = {}
+        if 'summary' not in entryD:
+            return summaryD, 'no summary'
+        try:
+            lines = self.read(entryD['summary'].path).decode().splitlines()
+        except (OSError, UnicodeDecodeError) as e:
+            return summaryD, 'unreadable summary: %s' % e
+        summaryD = check_dirvish.parse_summary(lines, check_dirvish.SummaryCache.parameterL)
+        if 'backup-begin' not in summaryD:
+            return summaryD, 'summary without backup-begin'
+        if 'backup-complete' not in summaryD:
+            return summaryD, 'incomplete'
+        logL = [name for name in LOG_OPENERS if name in entryD]
+        if not logL:
+            return summaryD, 'no log'
+        try:
+            # the first block shows a log is readable, e.g. a valid gzip header
+            self.read(entryD[logL[0]].path, LOG_OPENERS[logL[0]], limit=1)
+        except (OSError, EOFError) as e:
+            return summaryD, 'unreadable %s: %s' % (logL[0], e)
+        if 'tree' not in entryD or not entryD['tree'].is_dir():
+            return summaryD, 'no tree'
+        self.ops.wait()
+        try:
+            with os.scandir(entryD['tree'].path) as it:
+                if next(it, None) is None:
+                    return summaryD, 'empty tree'
+        except OSError as e:
+            return summaryD, 'cannot list tree: %s' % e.strerror
+        return summaryD, None
+
+    def backup_running(self):
+        """Checks if a dirvish process holds the lock file of the vault"""
+        self.ops.wait()
+        backup = check_dirvish.Backup(self.vault, self.base_path)
+        try:
+            backup.check_lockfile()
+        except OSError as e:
+            _log.warning("Cannot check the lock file of %r: %s", self.vault_base_path, e)
+            return False
+        return backup.lock_age is not None and not backup.lock_file_is_stale
+
+    def run(self):
+        """Returns the result of the audit as a dict, with the problems as [kind, image, detail]"""
+        start = time.monotonic()
+        problemL = []
+        historyD = self.histories()
+        directoryL = sorted(name for name, entry in self.listdir(self.vault_base_path).items()
+                            if entry.is_dir() and name != 'dirvish')
+        directoryS = set(directoryL)
+        expired = 0
+        for branch, imageL in sorted(historyD.items()):
+            retainedL = [image for image in imageL if image in directoryS]
+            newest = max(retainedL) if retainedL else None
+            for image in imageL:
+                if image in directoryS:
+                    continue
+                if newest is None or image > newest:
+                    problemL.append(['missing', image, 'in %s.hist' % branch])
+                else:
+                    expired += 1
+        historyS = set().union(*historyD.values())
+        checkedL = [(image,) + self.check_image(image) for image in directoryL]
+        # the newest image of every branch, a running backup is the newest of its branch
+        newestD = dict()
+        for image, summaryD, reason in checkedL:
+            branch = summaryD.get('branch')
+            newestD[branch] = max(newestD.get(branch, image), image)
+        running = self.backup_running()
+        for image, summaryD, reason in checkedL:
+            if reason == 'incomplete' and running and newestD[summaryD.get('branch')] == image:
+                _log.debug("Skipping %r, the backup running now", image)
+                continue
+            if image not in historyS:
+                problemL.append(['orphaned', image, reason or summaryD.get('status', '')])
+            elif reason is not None:
+                problemL.append(['corrupt', image, reason])
+        return {
+            'images': len(directoryL),
+            'history_entries': sum(map(len, historyD.values())),
+            'expired': expired,
+            'problems': problemL,
+            'seconds': round(time.monotonic() - start, 3),
+        }
+
+
+def audit_vault(task):
+    """The function of the worker processes, returns (base_path, vault, result)"""
+    base_path, vault, max_ops, max_bytes = task
+    try:
+        result = VaultAudit(base_path, vault, max_ops, max_bytes).run()
+    except OSError as e:
+        result = {'images': 0, 'history_entries': 0, 'expired': 0, 'seconds': 0,
+                  'problems': [['unreadable', '', str(e)]]}
+    return base_path, vault, result
+
+
+def vault_key(base_path, vault):
+    return os.path.join(base_path, vault)
+
+
+def load_state(filename, base_pathL):
+    """Returns the state of the unfinished audit of base_pathL in filename, or a new one"""
+    try:
+        with open(filename) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        state = None
+    except (OSError, ValueError) as e:
+        _log.warning("Cannot read state %r, starting anew: %s", filename, e)
+        state = None
+    if (state is None or state.get('version') != STATE_VERSION or state.get('finished')
+            or state.get('banks') != sorted(base_pathL)):
+        state = {'version': STATE_VERSION, 'banks': sorted(base_pathL), 'started': time.time(),
+                 'finished': None, 'vaults': {}}
+    else:
+        _log.info("Resuming the audit started at %s, %d vaults done", time.ctime(state['started']),
+                  len(state['vaults']))
+    return state
+
+
+def audit(base_pathL, state, state_file=None, workers=2, max_ops=None, max_bytes=None, timeout=None):
+    """Audits the vaults of base_pathL not in state yet, writes state to state_file after every vault
+
+    Returns True if all vaults are audited.
+    """
+    deadline = time.monotonic() + timeout if timeout else None
+    taskL = []
+    for base_path in base_pathL:
+        try:
+            vaultL = check_dirvish.BankBackup.find_vaults(base_path, branch=None)
+        except OSError as e:
+            _log.warning("Cannot list bank %r: %s", base_path, e)
+            continue
+        taskL.extend((base_path, vault, max_ops and max_ops / workers, max_bytes and max_bytes / workers)
+                     for vault in vaultL if vault_key(base_path, vault) not in state['vaults'])
+    _log.info("Auditing %d vaults", len(taskL))
+    if taskL:
+        pool = multiprocessing.Pool(min(workers, len(taskL)))
+        try:
+            resultI = pool.imap_unordered(audit_vault, taskL)
+            for _ in taskL:
+                remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+                base_path, vault, result = resultI.next(remaining)
+                _log.info("Audited %r: %d images, %d problems", vault_key(base_path, vault),
+                          result['images'], len(result['problems']))
+                state['vaults'][vault_key(base_path, vault)] = result
+                if state_file:
+                    check_dirvish.write_textfile(state_file, json.dumps(state))
+        except multiprocessing.TimeoutError:
+            left = sum(1 for base_path, vault, _, _ in taskL if vault_key(base_path, vault) not in state['vaults'])
+            _log.warning("Timeout, %d vaults left to audit", left)
+            return False
+        finally:
+            pool.terminate()
+            pool.join()
+    state['finished'] = time.time()
+    if state_file:
+        check_dirvish.write_textfile(state_file, json.dumps(state))
+    return True
+
+
+def report(state):
+    """Returns the state as a compact text report, one line per vault and kind of problem"""
+    resultL = state['vaults'].values()
+    problemL = [problem for result in resultL for problem in result['problems']]
+    countD = {kind: sum(1 for problem in problemL if problem[0] == kind)
+              for kind in ('orphaned', 'missing', 'corrupt', 'unreadable')}
+    lineL = ['%s audit of %d vaults, %d images: %s, %d expired history entries' % (
+        'complete' if state['finished'] else 'incomplete', len(resultL),
+        sum(result['images'] for result in resultL),
+        ', '.join('%d %s' % (count, kind) for kind, count in countD.items()),
+        sum(result['expired'] for result in resultL))]
+    for key, result in sorted(state['vaults'].items()):
+        for kind in countD:
+            kindL = [problem for problem in result['problems'] if problem[0] == kind]
+            if not kindL:
+                continue
+            itemL = ['%s (%s)' % (image, detail) if detail else image
+                     for _, image, detail in kindL[:REPORT_IMAGES]]
+            if len(kindL) > REPORT_IMAGES:
+                itemL.append('%d more' % (len(kindL) - REPORT_IMAGES))
+            lineL.append('%s %s %d: %s' % (key, kind, len(kindL), ', '.join(itemL)))
+    return '\n'.join(lineL) + '\n'
+
+
+def main():
+    argp = argparse.ArgumentParser()
+    argp.add_argument('-v', '--verbose', action='count', default=0,
+                      help='increase output verbosity (use up to 2 times)')
+    argp.add_argument('--base-path', action='append', metavar='BASE_PATH',
+                      help="bank to audit, can be given several times (/srv/backup)")
+    argp.add_argument('--state', default='/var/cache/dirvish_audit/state.json',
+                      help="file to save the progress of the audit in (%(default)s)")
+    argp.add_argument('--restart', action='store_true',
+                      help="discard the progress of an unfinished audit")
+    argp.add_argument('--workers', type=int, default=2,
+                      help="number of vaults audited concurrently (%(default)s)")
+    argp.add_argument('--max-ops', type=float,
+                      help="filesystem operations per second of all workers (no limit)")
+    argp.add_argument('--max-bytes', type=float,
+                      help="bytes read per second of all workers (no limit)")
+    argp.add_argument('-t', '--timeout', type=float,
+                      help="stop after TIMEOUT seconds, the next run resumes the audit (no limit)")
+    argp.add_argument('--format', choices=['text', 'json'], default='text',
+                      help="format of the report (%(default)s)")
+    args = argp.parse_args()
+    logging.basicConfig(level=[logging.WARNING, logging.INFO, logging.DEBUG][min(args.verbose, 2)])
+    base_pathL = args.base_path or ['/srv/backup']
+    os.makedirs(os.path.dirname(args.state) or '.', exist_ok=True)
+    if args.restart:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(args.state)
+    state = load_state(args.state, base_pathL)
+    complete = audit(base_pathL, state, args.state, args.workers, args.max_ops, args.max_bytes, args.timeout)
+    if args.format == 'json':
+        print(json.dumps(state, sort_keys=True, indent=1))
+    else:
+        print(report(state), end='')
+    if not complete:
+        sys.exit(2)
+    if any(result['problems'] for result in state['vaults'].values()):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
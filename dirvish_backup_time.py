@@ -1,29 +1,168 @@
 #! /usr/bin/python3
 
 """
-This script generates a list of Timestamp - length 
+This script generates a list of Timestamp - length
 if it is run in a dirvish vault.
+
+The durations of the images of all branches are kept in an append-only index
+per vault, so every run only parses the images not indexed yet.
 """
+import argparse
+import collections
+import csv
+import datetime
+import hashlib
+import json
 import logging
 import os
+import struct
+import sys
 
 import check_dirvish
-from IPython import embed as ipy
-import dateutil.parser
 
 config = {
     'base_pathL' :['/srv/backup'],
+    # sqlite file to cache parsed summaries in (see check_dirvish.SummaryCache)
+    'summary_cache' : None,
+    # directory of the duration indexes, None to parse all images on every run
+    'index_dir' : '/var/cache/dirvish_backup_time',
 }
 
 log = logging.getLogger('dirvish_duration')
 
-def backup_durations(bank, vault):
+DurationRecord = collections.namedtuple('DurationRecord', 'image branch begin duration status')
+
+class DurationIndex(object):
+    """ append-only file of the DurationRecords of a vault, oldest image first
+
+        After MAGIC every record is (length of the image name, length of the
+        branch, begin as epoch, duration in seconds, status code), followed by
+        image name and branch. An index without MAGIC, of the former format
+        without branches, is rebuilt.
+    """
+
+    MAGIC = b'dirvish duration index 2\n'
+    RECORD = struct.Struct('<BBqiB')
+    STATUS = ['success', 'warning', 'error', 'unknown']
+
+    def __init__(self, filename=None):
+        # without filename the index is only kept in memory
+        self.filename = filename
+        self.recordL = []
+        # the file has to be written anew
+        self.rebuild = True
+        if filename and os.path.exists(filename):
+            with open(filename, 'rb') as f:
+                data = f.read()
+            if data.startswith(self.MAGIC):
+                self.rebuild = False
+                self.recordL = self.parse(data, len(self.MAGIC))
+            else:
+                log.info('Rebuilding index %r of the former format', filename)
+
+    def parse(self, data, offset):
+        recordL = []
+        while offset + self.RECORD.size <= len(data):
+            image_length, branch_length, begin, duration, status = self.RECORD.unpack_from(data, offset)
+            offset += self.RECORD.size
+            if offset + image_length + branch_length > len(data):
+                # ignore a record that was not written completely
+                break
+            image = data[offset:offset + image_length].decode()
+            offset += image_length
+            branch = data[offset:offset + branch_length].decode()
+            offset += branch_length
+            recordL.append(DurationRecord(image, branch, begin, duration,
+                                          self.STATUS[min(status, len(self.STATUS) - 1)]))
+        recordL.sort()
+        return recordL
+
+    def pack(self, record):
+        """ returns the record as bytes, raises ValueError if a name is too long """
+        image, branch = record.image.encode(), record.branch.encode()
+        if len(image) > 255 or len(branch) > 255:
+            raise ValueError('name too long for the index: %r' % (record,))
+        return self.RECORD.pack(len(image), len(branch), record.begin, record.duration,
+                                self.STATUS.index(record.status)) + image + branch
+
+    def update(self, backups):
+        """ add the completed images of the Backup backups not indexed yet
+
+            The images of all branches of the vault are indexed, also the ones
+            in no history file, e.g. failed backups. The images are walked
+            newest first, down to the last indexed image of every branch.
+        """
+        branchL = (check_dirvish.BankBackup.find_branches(backups.vault_base_path, backups.fs)
+                   or [backups.branch])
+        lastD = dict()    # branch -> last indexed image
+        for record in self.recordL:
+            lastD[record.branch] = max(lastD.get(record.branch, record.image), record.image)
+        # a branch without records is walked down to the oldest image of its
+        # history, an empty index completely
+        oldestL = []
+        for branch in branchL:
+            if branch not in lastD:
+                oldest = None
+                for oldest in backups.history(branch):
+                    pass
+                if oldest is not None:
+                    oldestL.append(oldest)
+        indexedS = {record.image for record in self.recordL}
+        newL = []
+        for image in backups.branch_backups(branchL):
+            if (self.recordL and all(image <= last for last in lastD.values())
+                    and all(image < oldest for oldest in oldestL)):
+                break
+            if image in indexedS:
+                continue
+            try:
+                d = backups.parse_backup(image)
+                end = check_dirvish.parse_timestamp(d['backup-complete'])
+                begin = check_dirvish.parse_timestamp(d['backup-begin'])
+            except (check_dirvish.E_PathNotAccessible, check_dirvish.E_BackupNotValid,
+                    KeyError, ValueError) as e:
+                log.debug('Skip image %r: %r', image, e)
+                continue
+            status = (d.get('status') or 'unknown').split()[0].casefold()
+            if status not in self.STATUS:
+                status = 'error'
+            record = DurationRecord(image, d.get('branch', ''), int(begin.timestamp()),
+                                    round((end - begin).total_seconds()), status)
+            try:
+                self.pack(record)
+            except ValueError as e:
+                log.warning('Skip image %r: %s', image, e)
+                continue
+            newL.append(record)
+        newL.sort()
+        self.recordL.extend(newL)
+        self.recordL.sort()
+        if self.filename and (newL or self.rebuild):
+            with open(self.filename, 'wb' if self.rebuild else 'ab') as f:
+                if self.rebuild:
+                    f.write(self.MAGIC)
+                for record in self.recordL if self.rebuild else newL:
+                    f.write(self.pack(record))
+            self.rebuild = False
+        log.info('Indexed %d new images', len(newL))
+        return newL
+
+def index_name(vault_base_path):
+    """ returns the file name of the index of the vault at vault_base_path
+
+        The name carries a hash of the whole path, so vaults of the same name
+        in different banks do not share an index.
+    """
+    path = os.path.normpath(os.path.abspath(vault_base_path))
+    return '%s-%s.idx' % (os.path.basename(path), hashlib.sha1(path.encode()).hexdigest()[:12])
+
+def duration_index(bank, vault):
+    """ returns the updated DurationIndex of vault, or None if it is not a dirvish vault """
     log.debug('Check %r as a valid dirvish backup.', os.path.join(bank, vault))
-    backups = check_dirvish.Backup(vault, bank)
-    result = list()
-    backups.duration=None
-    backups.last_try=None
-    backups.last_success=None
+    summary_cache = None
+    if config['summary_cache']:
+        summary_cache = check_dirvish.SummaryCache(config['summary_cache'])
+    backups = check_dirvish.Backup(vault, bank, summary_cache=summary_cache)
 
     try:
         backups.check_path_accessible(backups.base_path)
@@ -33,28 +172,51 @@ def backup_durations(bank, vault):
         return None
     except check_dirvish.E_VaultIsNotDirvishDirectory as e:
         return None
-    backups.check_backups()
-    for backup in backups.backups():
-        try:
-            d = backups.parse_backup(backup)
-            
-        except:
-            continue
+    filename = None
+    if config['index_dir']:
         try:
-            end = dateutil.parser.parse(d['backup-complete'])
-            begin = dateutil.parser.parse(d['backup-begin'])
-        except KeyError:
-            continue
-        result.append((backup, end - begin))
-    result.sort()
-    return result
+            os.makedirs(config['index_dir'], exist_ok=True)
+            filename = os.path.join(config['index_dir'], index_name(backups.vault_base_path))
+        except OSError as e:
+            log.warning('Cannot create %r, parsing all images: %s', config['index_dir'], e)
+    index = DurationIndex(filename)
+    try:
+        index.update(backups)
+    except OSError as e:
+        log.warning('Cannot write index %r: %s', filename, e)
+    if summary_cache is not None:
+        summary_cache.commit()
+    return index
+
+def backup_durations(bank, vault):
+    index = duration_index(bank, vault)
+    if index is None:
+        return None
+    return [(r.image, datetime.timedelta(seconds=r.duration)) for r in index.recordL]
 
 
 if __name__=='__main__':
-    # current working directory
-    cwd = os.getcwd()
-    vault = os.path.basename(cwd)
-    bank = os.path.dirname(cwd)
-    result = backup_durations(bank, vault)
-    for b, duration  in result:
-        print(b , duration)
+    argp = argparse.ArgumentParser()
+    argp.add_argument('--format', choices=['text', 'csv', 'json'], default='text',
+                      help='output format (%(default)s)')
+    argp.add_argument('--index-dir', default=config['index_dir'],
+                      help='directory of the duration indexes (%(default)s)')
+    argp.add_argument('vault_path', nargs='?', default=os.getcwd(),
+                      help='path of the vault (current working directory)')
+    args = argp.parse_args()
+    config['index_dir'] = args.index_dir
+    vault_path = os.path.normpath(args.vault_path)
+    vault = os.path.basename(vault_path)
+    bank = os.path.dirname(vault_path)
+    index = duration_index(bank, vault)
+    if index is None:
+        sys.exit('%r is not a dirvish vault' % vault_path)
+    if args.format == 'csv':
+        writer = csv.writer(sys.stdout)
+        writer.writerow(DurationRecord._fields)
+        writer.writerows(index.recordL)
+    elif args.format == 'json':
+        print(json.dumps([r._asdict() for r in index.recordL], indent=1))
+    else:
+        for r in index.recordL:
+            print(r.image, r.branch, datetime.timedelta(seconds=r.duration))
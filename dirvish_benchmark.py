@@ -0,0 +1,398 @@
+#! /usr/bin/python3
+
+"""
+Benchmarks for the hot paths of the dirvish checks.
+
+Every benchmark prints its result as one json object per line.
+
+    ./dirvish_benchmark.py blacklist --rules 5000 --paths 500
+    ./dirvish_benchmark.py summary --summaries 2000
+    ./dirvish_benchmark.py bank --vaults 50 --images 365 --branches default,weekly
+    ./dirvish_benchmark.py generate --vaults 5 --images 30 /tmp/bank
+    ./dirvish_benchmark.py startup --max-ms 150
+"""
+import argparse
+import builtins
+import contextlib
+import datetime
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+import check_dirvish
+
+
+def summary_lines(rng, client, image, branch, begin, complete=True):
+    """ the lines of a summary file like dirvish writes it """
+    summaryL = ['client: %s' % client, 'tree: /', 'branch: %s' % branch,
+                'Image: %s' % image, 'Reference: %s' % branch, 'exclude:']
+    summaryL += ['        /var/cache/pkg%03d/' % i for i in range(rng.randrange(20, 200))]
+    summaryL += ['', 'ACTION: rsync -vrltH --delete -pgo --stats -D --numeric-ids',
+                 'Backup-begin: %s' % begin]
+    if complete:
+        end = begin + datetime.timedelta(seconds=rng.randrange(60, 36000))
+        status = rng.choice(['success'] * 8 + ['warning (24) -- file vanished on sender',
+                                               'error (23) -- partial transfer'])
+        summaryL += ['Backup-complete: %s' % end, 'Status: %s' % status]
+    return [line + '\n' for line in summaryL]
+
+def generate_bank(base_path, vaults, images, branchL=('default',), history_extra=0,
+                  broken=0.0, running=0.0, seed=0):
+    """ create a synthetic dirvish bank in base_path
+
+        Every vault gets images backups per branch, one per day, and
+        history_extra additional history entries of expired images.
+        The fraction broken of the images lacks the summary or tree, and the
+        newest image of the fraction running of the vaults is still in progress.
+    """
+    rng = random.Random(seed)
+    now = datetime.datetime.now().replace(microsecond=0)
+    for v in range(vaults):
+        vault_base_path = os.path.join(base_path, 'vault%05d' % v)
+        dirvish_dir = os.path.join(vault_base_path, 'dirvish')
+        os.makedirs(dirvish_dir)
+        vault_running = rng.random() < running
+        for branch in branchL:
+            with open(os.path.join(dirvish_dir, '%s.conf' % branch), 'w') as f:
+                f.write('client: vault%05d\nbranch-default: %s\n' % (v, branch))
+            historyL = ['image\tcreated\treference\texpire\n']
+            for day in range(images + history_extra, 0, -1):
+                begin = now - datetime.timedelta(days=day, minutes=rng.randrange(60))
+                image = begin.strftime('%Y-%m-%d_%H:%M') + ('' if branch == 'default' else '-' + branch)
+                complete = day > 1 or not vault_running
+                if complete:
+                    historyL.append('%s\t%s\t%s\t+30 days\n' % (image, begin, branch))
+                if day > images:
+                    # expired, only in the history
+                    continue
+                image_dir = os.path.join(vault_base_path, image)
+                os.makedirs(os.path.join(image_dir, 'tree', 'etc'))
+                with open(os.path.join(image_dir, 'log'), 'w') as f:
+                    f.write('sending incremental file list\n')
+                image_broken = rng.random() < broken
+                if image_broken and rng.random() < 0.5:
+                    shutil.rmtree(os.path.join(image_dir, 'tree'))
+                    image_broken = False
+                if image_broken:
+                    continue
+                with open(os.path.join(image_dir, 'summary'), 'w') as f:
+                    f.writelines(summary_lines(rng, 'vault%05d' % v, image, branch, begin, complete))
+            with open(os.path.join(dirvish_dir, '%s.hist' % branch), 'w') as f:
+                f.writelines(historyL)
+
+@contextlib.contextmanager
+def count_calls(countD):
+    """ count the calls of the filesystem functions used by the checks """
+    originalD = {(os, name): getattr(os, name)
+                 for name in ('stat', 'lstat', 'access', 'listdir', 'scandir', 'walk', 'pread')}
+    originalD[(builtins, 'open')] = builtins.open
+
+    def counting(name, function):
+        def wrapper(*args, **kwargs):
+            countD[name] = countD.get(name, 0) + 1
+            return function(*args, **kwargs)
+        return wrapper
+
+    for (module, name), function in originalD.items():
+        setattr(module, name, counting(name, function))
+    try:
+        yield countD
+    finally:
+        for (module, name), function in originalD.items():
+            setattr(module, name, function)
+
+def proc_io():
+    """ the i/o counters of this process, see proc(5) """
+    try:
+        with open('/proc/self/io') as f:
+            return {k: int(v) for k, v in (l.split(': ') for l in f)}
+    except OSError:
+        return {}
+
+def drop_caches():
+    """ drop the page cache for a cold run, returns False if not permitted """
+    try:
+        os.sync()
+        with open('/proc/sys/vm/drop_caches', 'w') as f:
+            f.write('3\n')
+        return True
+    except OSError:
+        return False
+
+def measure(name, function, cold=False, **parameterD):
+    """ time one call of function and count its syscalls """
+    if cold:
+        cache = 'cold' if drop_caches() else 'cold-unavailable'
+    else:
+        # populate the page cache
+        function()
+        cache = 'warm'
+    countD = dict()
+    io_before = proc_io()
+    with count_calls(countD):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+    io_after = proc_io()
+    result = {'benchmark': name, 'cache': cache, 'seconds': elapsed, 'calls': countD}
+    for key in ('syscr', 'rchar', 'read_bytes'):
+        if key in io_after:
+            result[key] = io_after[key] - io_before[key]
+    result.update(parameterD)
+    return result
+
+def bench_bank(base_path, branchL, cold=False):
+    """ time the entry points of the checks on every vault of the bank base_path """
+    vaultL = sorted(os.listdir(base_path))
+
+    def backups():
+        for vault in vaultL:
+            for branch in branchL:
+                list(check_dirvish.Backup(vault, base_path, branch).backups())
+
+    def parse_backup():
+        for vault in vaultL:
+            backup = check_dirvish.Backup(vault, base_path)
+            for image in backup.backups():
+                try:
+                    backup.parse_backup(image)
+                except (check_dirvish.E_PathNotAccessible, check_dirvish.E_BackupNotValid):
+                    pass
+
+    def check_backups():
+        for vault in vaultL:
+            for branch in branchL:
+                backup = check_dirvish.Backup(vault, base_path, branch)
+                backup.duration = backup.last_try = backup.last_success = None
+                backup.check_backups()
+
+    def include_list():
+        import generate_full_backup_includes
+        # the include list is printed, it would end up in the results
+        with contextlib.redirect_stdout(devnull):
+            generate_full_backup_includes.backup_dirs([base_path], generate_full_backup_includes.PathTrie())
+
+    resultL = []
+    with open(os.devnull, 'w') as devnull:
+        for name, function in [('backups', backups), ('parse_backup', parse_backup),
+                               ('check_backups', check_backups), ('include_list', include_list)]:
+            resultL.append(measure(name, function, cold, vaults=len(vaultL), branches=list(branchL)))
+    return resultL
+
+def is_blacklisted_commonprefix(path, filter_list):
+    """ the former implementation of is_blacklisted, as reference """
+    _path = os.path.normpath(path)
+    _filterL = filter(lambda e,_path=_path: os.path.commonprefix([_path, e])==e, filter_list)
+    return bool(list(_filterL))
+
+def parse_summary_split(lines, parameterL):
+    """ the former summary parser of Backup.parse_backup, as reference """
+    _parameterL = [s.casefold() for s in parameterL]
+    _resultD = dict()
+    for line in lines:
+        parts = line.strip().split(': ')
+        if len(parts) >= 2:
+            parameter = parts[0]
+            value = " ".join(parts[1:])
+            check_dirvish._log.debug('Found parameter %r with value %r', parameter.casefold(), value)
+            parameter_casefold = parameter.casefold()
+            if parameter_casefold in _parameterL:
+                check_dirvish._log.debug("Adding parameter %r to returnDict", parameter_casefold)
+                _resultD[parameter_casefold] = value
+    return _resultD
+
+def status_ok_recompiled(status):
+    """ the former Backup.status_has_errors, compiling its regex on every call """
+    import re
+    regexp = re.compile(r"""
+                (?P<status>\w+)? \s*
+                (\((?P<rsyncexitcode>\d+)\))? \s*
+                (--)? \s*
+                (?P<description>.*)?
+             """, re.IGNORECASE|re.VERBOSE)
+    return regexp.search(status).groupdict()['status'] in ['success', 'warning']
+
+def bench_summary(summaries, repeat):
+    """ compare the former split based summary parser with check_dirvish.parse_summary """
+    rng = random.Random(0)
+    now = datetime.datetime.now().replace(microsecond=0)
+    parameterL = check_dirvish.SummaryCache.parameterL
+    summaryL = [summary_lines(rng, 'vault', 'image%d' % i, 'default', now, complete=rng.random() > 0.05)
+                for i in range(summaries)]
+
+    # both parsers have to agree
+    for lines in summaryL:
+        assert parse_summary_split(lines, parameterL) == check_dirvish.parse_summary(lines, parameterL)
+
+    def former():
+        for lines in summaryL:
+            d = parse_summary_split(lines, parameterL)
+            if 'status' in d:
+                status_ok_recompiled(d['status'])
+
+    def current():
+        for lines in summaryL:
+            d = check_dirvish.parse_summary(lines, parameterL)
+            if 'status' in d:
+                check_dirvish.Backup.status_has_errors(d['status'])
+
+    split = min(timeit.repeat(former, number=1, repeat=repeat))
+    table = min(timeit.repeat(current, number=1, repeat=repeat))
+    return {
+        'benchmark': 'summary',
+        'summaries': summaries,
+        'lines': sum(map(len, summaryL)),
+        'split_us_per_summary': split / summaries * 1e6,
+        'table_us_per_summary': table / summaries * 1e6,
+        'speedup': split / table,
+    }
+
+def bench_blacklist(rules, paths, repeat):
+    """ compare the linear commonprefix scan with the PathTrie lookup """
+    import generate_full_backup_includes
+    rng = random.Random(0)
+    filterL = ['/srv/backup/host%08d/%s' % (rng.randrange(rules * 10), d)
+               for d in rng.choices(['', 'tree', 'tree/var/cache'], k=rules)]
+    filterL = [os.path.normpath(p) for p in filterL]
+    filterTrie = generate_full_backup_includes.PathTrie(filterL)
+    pathL = ['/srv/backup/host%08d' % rng.randrange(rules * 10) for _ in range(paths)]
+
+    # both implementations have to agree on paths without sibling prefixes
+    for path in pathL:
+        assert (path in filterTrie) == is_blacklisted_commonprefix(path, filterL), path
+
+    commonprefix = min(timeit.repeat(
+        lambda: [is_blacklisted_commonprefix(p, filterL) for p in pathL], number=1, repeat=repeat))
+    trie = min(timeit.repeat(
+        lambda: [p in filterTrie for p in pathL], number=1, repeat=repeat))
+    return {
+        'benchmark': 'blacklist',
+        'rules': rules,
+        'paths': paths,
+        'commonprefix_s': commonprefix,
+        'trie_s': trie,
+        'speedup': commonprefix / trie,
+    }
+
+STARTUP_MODULES = ['check_dirvish', 'check_dirvish_daemon', 'dirvish_exporter',
+                   'dirvish_backup_time', 'generate_full_backup_includes']
+
+def import_time(module):
+    """ returns the cumulative import time of module in us and the self times of all imported modules """
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import %s' % module],
+                             cwd=os.path.dirname(os.path.abspath(__file__)),
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    if process.returncode:
+        raise RuntimeError('import %s failed: %s' % (module, process.stderr.strip().splitlines()[-1]))
+    selfD = {}
+    cumulative = None
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        selfD[name.strip()] = int(self_us)
+        if name.strip() == module:
+            cumulative = int(cumulative_us)
+    return cumulative, selfD
+
+def bench_startup(moduleL, repeat, heaviest=5, vaults=5, images=10):
+    """ time the imports of the scripts, and a whole check_dirvish.py run on a small bank """
+    resultL = []
+    for module in moduleL:
+        runL = [import_time(module) for _ in range(repeat)]
+        cumulative, selfD = min(runL, key=lambda run: run[0])
+        resultL.append({
+            'benchmark': 'startup',
+            'module': module,
+            'import_ms': cumulative / 1000,
+            'heaviest': [[name, self_us / 1000] for name, self_us
+                         in sorted(selfD.items(), key=lambda item: -item[1])[:heaviest]],
+        })
+    base_path = tempfile.mkdtemp(prefix='dirvish_benchmark_')
+    try:
+        generate_bank(base_path, vaults, images)
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'check_dirvish.py')
+        commandL = [sys.executable, script, '--base-path', base_path, '--all-vaults', '-w', '1000000000']
+        wallL = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run(commandL, stdout=subprocess.DEVNULL)
+            wallL.append(time.perf_counter() - start)
+    finally:
+        shutil.rmtree(base_path)
+    resultL.append({
+        'benchmark': 'startup',
+        'module': 'check_dirvish.py --all-vaults',
+        'vaults': vaults,
+        'images': images,
+        'wall_ms': min(wallL) * 1000,
+    })
+    return resultL
+
+if __name__=='__main__':
+    argp = argparse.ArgumentParser()
+    argp.add_argument('--repeat', type=int, default=5,
+                      help='repetitions, the fastest one is reported (%(default)s)')
+    subparsers = argp.add_subparsers(dest='benchmark', required=True)
+    blacklist = subparsers.add_parser('blacklist', help='is_blacklisted with many blacklist entries')
+    blacklist.add_argument('--rules', type=int, default=5000, help='number of blacklist entries (%(default)s)')
+    blacklist.add_argument('--paths', type=int, default=500, help='number of checked vaults (%(default)s)')
+    summary = subparsers.add_parser('summary', help='parsing summary files')
+    summary.add_argument('--summaries', type=int, default=2000, help='number of summaries (%(default)s)')
+    startup = subparsers.add_parser('startup', help='import time of the scripts')
+    startup.add_argument('--module', action='append',
+                         help='module to import, can be given several times (all scripts)')
+    startup.add_argument('--max-ms', type=float,
+                         help='exit with 1 if a module takes longer than MAX_MS to import')
+    for name, help in [('bank', 'the checks on a synthetic bank'), ('generate', 'only create a synthetic bank')]:
+        bank = subparsers.add_parser(name, help=help)
+        bank.add_argument('--vaults', type=int, default=20, help='number of vaults (%(default)s)')
+        bank.add_argument('--images', type=int, default=60, help='number of images per branch (%(default)s)')
+        bank.add_argument('--branches', default='default', help='comma separated branches (%(default)s)')
+        bank.add_argument('--history-extra', type=int, default=0,
+                          help='expired images per branch, only in the history file (%(default)s)')
+        bank.add_argument('--broken', type=float, default=0.02,
+                          help='fraction of images without summary or tree (%(default)s)')
+        bank.add_argument('--running', type=float, default=0.1,
+                          help='fraction of vaults with a backup in progress (%(default)s)')
+        if name == 'bank':
+            bank.add_argument('--cold', action='store_true',
+                              help='drop the page cache before every run (needs root)')
+        else:
+            bank.add_argument('base_path', help='directory to create the bank in')
+    args = argp.parse_args()
+
+    if args.benchmark == 'blacklist':
+        resultL = [bench_blacklist(args.rules, args.paths, args.repeat)]
+    elif args.benchmark == 'summary':
+        resultL = [bench_summary(args.summaries, args.repeat)]
+    elif args.benchmark == 'startup':
+        resultL = bench_startup(args.module or STARTUP_MODULES, args.repeat)
+    else:
+        branchL = args.branches.split(',')
+        if args.benchmark == 'generate':
+            generate_bank(args.base_path, args.vaults, args.images, branchL,
+                          args.history_extra, args.broken, args.running)
+            resultL = []
+        else:
+            base_path = tempfile.mkdtemp(prefix='dirvish_benchmark_')
+            try:
+                generate_bank(base_path, args.vaults, args.images, branchL,
+                              args.history_extra, args.broken, args.running)
+                resultL = bench_bank(base_path, branchL, args.cold)
+            finally:
+                shutil.rmtree(base_path)
+            for result in resultL:
+                result.update(images=args.images, history_extra=args.history_extra)
+    for result in resultL:
+        print(json.dumps(result, sort_keys=True))
+    if args.benchmark == 'startup' and args.max_ms is not None:
+        slowL = [r['module'] for r in resultL if r.get('import_ms', 0) > args.max_ms]
+        if slowL:
+            sys.exit('import slower than %gms: %s' % (args.max_ms, ', '.join(slowL)))
@@ -0,0 +1,238 @@
+#! /usr/bin/python3
+
+"""
+Exporter of the state of all vaults and branches of dirvish banks, as
+OpenMetrics text for Prometheus or as json.
+
+The vaults are probed with the same code as check_dirvish.py. The results
+are kept for --ttl seconds, so the scrape interval does not multiply the
+load on the disks.
+
+    ./dirvish_exporter.py --base-path /srv/backup --textfile /var/lib/prometheus/node-exporter/dirvish.prom
+    ./dirvish_exporter.py --base-path /srv/backup --listen 127.0.0.1:9478
+"""
+import argparse
+import http.server
+import json
+import logging
+import os
+import time
+
+import check_dirvish
+
+_log = logging.getLogger('nagiosplugin')
+
+# context of the metric of Backup.probe() -> (name of the exported metric, unit, help)
+EXPORTED_METRICS = {
+    'last_success': ('dirvish_last_success', 'seconds', 'Seconds since the begin of the last successful backup'),
+    'last_try': ('dirvish_last_try', 'seconds', 'Seconds since the begin of the last completed backup'),
+    'duration': ('dirvish_duration', 'seconds', 'Seconds the last completed backup took'),
+    'running_backup_for': ('dirvish_running_backup_for', 'seconds',
+                           'Seconds since the begin of the running backup, 0 if none is running'),
+    'stale_lockfile': ('dirvish_stale_lockfile', '', '1 if the lock file of the vault is stale'),
+    'lock_age': ('dirvish_lock_age', 'seconds', 'Seconds since the lock file of the vault was written'),
+    'valid_backup_found': ('dirvish_valid_backup_found', '', '1 if a successful backup was found'),
+}
+
+OPENMETRICS_CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+
+class BankState(object):
+    """The metrics of all vaults and branches of some banks, probed at most every ttl seconds"""
+
+    def __init__(self, base_pathL, ttl=300, timeout=None, jobs=4, jobs_per_bank=2, summary_cache=None):
+        self.base_pathL = base_pathL
+        self.ttl = ttl
+        # seconds after which the vaults not probed yet are reported as down
+        self.timeout = timeout
+        self.engine = check_dirvish.ProbeEngine(jobs, jobs_per_bank)
+        self.summary_cache = summary_cache
+        self.probe_time = None
+        self.probe_seconds = None
+        self.sampleL = []
+        # the Backups of earlier probes still running after the timeout, e.g. on a hung mount
+        self.hungL = []
+
+    def probe(self):
+        _log.info("Probing the vaults of %r", self.base_pathL)
+        start = time.monotonic()
+        fs = check_dirvish.FileSystem()
+        self.hungL = [backup for backup in self.hungL if backup.collecting]
+        # a vault is not probed again while its former probe hangs, so the threads do not pile up
+        hungS = {(backup.base_path, backup.vault) for backup in self.hungL}
+        backupL = []    # the Backups probed now
+        allL = []
+        for base_path in self.base_pathL:
+            try:
+                vaultL = sorted(name for name, entry in fs.entries(base_path).items() if entry.is_dir())
+            except OSError as e:
+                _log.warning("Cannot list bank %r: %s", base_path, e)
+                continue
+            for vault in vaultL:
+                # the branches of a vault are classified in one pass over its images
+                branchL = check_dirvish.BankBackup.find_branches(os.path.join(base_path, vault), fs)
+                vault_backupL = check_dirvish.BankBackup.for_branches(vault, base_path, branchL,
+                                                                      summary_cache=self.summary_cache, fs=fs)
+                if (base_path, vault) in hungS:
+                    _log.warning("Vault %r: former probe still running, skipped", os.path.join(base_path, vault))
+                    for backup in vault_backupL:
+                        backup.metricL = [backup.metric('probe_finished', 0, min=0, max=1)]
+                else:
+                    backupL.extend(vault_backupL)
+                allL.extend(vault_backupL)
+        self.engine.run(backupL, self.timeout)
+        self.hungL.extend(backup for backup in backupL if backup.collecting)
+        self.sampleL = []
+        for backup in allL:
+            metricD = {metric.context: metric.value for metric in backup.metricL}
+            up = 'vault_accessible' not in metricD and 'probe_finished' not in metricD
+            self.sampleL.append({
+                'bank': backup.base_path,
+                'vault': backup.vault,
+                'branch': backup.branch,
+                'up': int(up),
+                'metrics': {context: int(value) for context, value in metricD.items()
+                            if context in EXPORTED_METRICS},
+            })
+        self.probe_time = time.time()
+        self.probe_seconds = time.monotonic() - start
+
+    def samples(self):
+        """Returns the samples of the vaults, probing them again if they are older than ttl"""
+        if self.probe_time is None or time.time() - self.probe_time > self.ttl:
+            self.probe()
+        # the ages grow while the samples are cached
+        elapsed = round(time.time() - self.probe_time)
+        sampleL = []
+        for sample in self.sampleL:
+            metricD = dict(sample['metrics'])
+            for context in check_dirvish.AGE_METRICS:
+                if context in metricD:
+                    metricD[context] += elapsed
+            if sample['up']:
+                metricD.setdefault('running_backup_for', 0)
+            sampleL.append(dict(sample, metrics=metricD))
+        return sampleL
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def openmetrics(state, sampleL):
+    """Returns the samples as OpenMetrics text"""
+    lineL = []
+
+    def family(name, unit, help):
+        lineL.append('# TYPE %s gauge' % name)
+        if unit:
+            lineL.append('# UNIT %s %s' % (name, unit))
+        lineL.append('# HELP %s %s' % (name, help))
+
+    def labels(sample):
+        return 'bank="%s",vault="%s",branch="%s"' % tuple(
+            escape(sample[k]) for k in ('bank', 'vault', 'branch'))
+
+    family('dirvish_vault_up', '', '1 if the vault could be probed')
+    for sample in sampleL:
+        lineL.append('dirvish_vault_up{%s} %d' % (labels(sample), sample['up']))
+    for context, (name, unit, help) in EXPORTED_METRICS.items():
+        if unit:
+            name = '%s_%s' % (name, unit)
+        family(name, unit, help)
+        for sample in sampleL:
+            if context in sample['metrics']:
+                lineL.append('%s{%s} %d' % (name, labels(sample), sample['metrics'][context]))
+    family('dirvish_exporter_probe_timestamp_seconds', 'seconds', 'Time of the last probe of the vaults')
+    lineL.append('dirvish_exporter_probe_timestamp_seconds %.3f' % state.probe_time)
+    family('dirvish_exporter_probe_duration_seconds', 'seconds', 'Seconds the last probe of the vaults took')
+    lineL.append('dirvish_exporter_probe_duration_seconds %.3f' % state.probe_seconds)
+    lineL.append('# EOF')
+    return '\n'.join(lineL) + '\n'
+
+
+def as_json(state, sampleL):
+    return json.dumps({'probe_time': state.probe_time, 'probe_seconds': state.probe_seconds,
+                       'vaults': sampleL}, sort_keys=True) + '\n'
+
+
+class ExporterRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Serves /metrics as OpenMetrics text and /metrics.json as json"""
+
+    def do_GET(self):
+        if self.path not in ('/metrics', '/metrics.json'):
+            self.send_error(404)
+            return
+        try:
+            sampleL = self.server.state.samples()
+        except Exception:
+            _log.exception("Cannot probe the vaults")
+            self.send_error(500)
+            return
+        if self.path == '/metrics':
+            body, content_type = openmetrics(self.server.state, sampleL), OPENMETRICS_CONTENT_TYPE
+        else:
+            body, content_type = as_json(self.server.state, sampleL), 'application/json'
+        body = body.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        _log.debug("%s - %s", self.address_string(), format % args)
+
+
+def main():
+    argp = argparse.ArgumentParser()
+    argp.add_argument('-v', '--verbose', action='count', default=0,
+                      help='increase output verbosity (use up to 2 times)')
+    argp.add_argument('--base-path', action='append', metavar='BASE_PATH',
+                      help="bank to export, can be given several times (/srv/backup)")
+    argp.add_argument('--ttl', type=int, default=300,
+                      help="probe the vaults again after TTL seconds (%(default)s)")
+    argp.add_argument('-t', '--timeout', type=float, default=60,
+                      help="report the vaults not probed after TIMEOUT seconds as down (%(default)s)")
+    argp.add_argument('--jobs', type=int, default=4,
+                      help="number of vaults probed concurrently (%(default)s)")
+    argp.add_argument('--jobs-per-bank', type=int, default=2,
+                      help="number of vaults of the same bank probed concurrently (%(default)s)")
+    argp.add_argument('--summary-cache', metavar='FILE',
+                      help="sqlite file to cache the parsed summaries of completed backups in")
+    argp.add_argument('--format', choices=['openmetrics', 'json'], default='openmetrics',
+                      help="format of --textfile and of the standard output (%(default)s)")
+    output = argp.add_mutually_exclusive_group()
+    output.add_argument('--textfile', metavar='FILE',
+                        help="write the metrics to FILE, e.g. for the textfile collector of the node exporter. "
+                             "Nothing is done if FILE is younger than TTL")
+    output.add_argument('--listen', metavar='[HOST:]PORT',
+                        help="serve /metrics and /metrics.json via http")
+    args = argp.parse_args()
+    logging.basicConfig(level=[logging.WARNING, logging.INFO, logging.DEBUG][min(args.verbose, 2)])
+    summary_cache = check_dirvish.SummaryCache(args.summary_cache) if args.summary_cache else None
+    state = BankState(args.base_path or ['/srv/backup'], args.ttl, args.timeout or None,
+                      args.jobs, args.jobs_per_bank, summary_cache)
+    if args.listen:
+        host, _, port = args.listen.rpartition(':')
+        with http.server.HTTPServer((host or '127.0.0.1', int(port)), ExporterRequestHandler) as server:
+            server.state = state
+            _log.info("Serving the vaults of %r on %r", state.base_pathL, args.listen)
+            server.serve_forever()
+        return
+    if args.textfile:
+        try:
+            if time.time() - os.stat(args.textfile).st_mtime < args.ttl:
+                _log.info("%r is younger than %ds, not probing", args.textfile, args.ttl)
+                return
+        except FileNotFoundError:
+            pass
+    format = openmetrics if args.format == 'openmetrics' else as_json
+    text = format(state, state.samples())
+    if args.textfile:
+        check_dirvish.write_textfile(args.textfile, text)
+    else:
+        print(text, end='')
+
+if __name__ == '__main__':
+    main()
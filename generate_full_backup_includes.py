@@ -5,18 +5,13 @@ This script generates a include list (for rsync) for every suspected backup dire
 
 If it is a dirvirsh directory, it find the latest complete snapshot.
 """
+import argparse
+import concurrent.futures
 import logging
 import os
+import threading
 
 import check_dirvish
-from IPython import embed as ipy
-
-try:
-    from mako.template import Template
-    from mako import exceptions
-except ImportError as e:
-    print('please install package python3-mako')
-    raise e
 
 config = {
     'base_pathL' :['/srv/backup'],
@@ -25,17 +20,19 @@ config = {
     'blackListFileDir' : '/etc/ptx_backup/blacklist.d/',
     'blackListFileExtension' : '.list',
     'templateFile' : '/etc/ptx_backup/template.mako',
+    # number of vaults probed concurrently
+    'jobs' : 1,
+    # number of vaults probed concurrently on the same bank,
+    # so one slow disk does not occupy all jobs (None: no limit)
+    'jobsPerBank' : None,
 }
 
 log = logging.getLogger('nagiosplugin')
 
-def backup_dir(bank, vault):
+def backup_dir(bank, vault, fs=None):
     log.debug('Check %r as a valid dirvish backup.', os.path.join(bank, vault))
-    backup = check_dirvish.Backup(vault, bank)
+    backup = check_dirvish.Backup(vault, bank, fs=fs)
     print(backup.vault_base_path)
-    backup.duration = None
-    backup.last_try = None
-    backup.last_success = None
 
     try:
         backup.check_path_accessible(backup.base_path)
@@ -45,54 +42,141 @@ def backup_dir(bank, vault):
         return None
     except check_dirvish.E_VaultIsNotDirvishDirectory as e:
         return None
-    backup.check_backups()
-    last_backup_subdir = getattr(backup, 'last_successful_backup', None)
+    # reads only the summaries down to the latest successful image
+    last_backup_subdir = backup.latest_successful_backup()
     if last_backup_subdir:
         return os.path.join(bank, vault, last_backup_subdir)
     return None
 
+class PathTrie(object):
+    """ set of paths, that matches a path if the path or one of its parents is in the set.
+
+        Paths are compared by whole components, so '/srv/backup/foo' does not
+        match '/srv/backup/foobar'. A lookup costs O(depth of the path).
+    """
+
+    def __init__(self, pathL=()):
+        self.root = dict()
+        self.pathL = []
+        for path in pathL:
+            self.add(path)
+
+    @staticmethod
+    def components(path):
+        return [c for c in os.path.normpath(path).split(os.sep) if c]
+
+    def add(self, path):
+        node = self.root
+        for component in self.components(path):
+            node = node.setdefault(component, dict())
+        # the key None marks the end of a path
+        node[None] = True
+        self.pathL.append(path)
+
+    def __contains__(self, path):
+        node = self.root
+        if None in node:
+            return True
+        for component in self.components(path):
+            node = node.get(component)
+            if node is None:
+                return False
+            if None in node:
+                return True
+        return False
+
+    def __len__(self):
+        return len(self.pathL)
+
+    def __iter__(self):
+        return iter(self.pathL)
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.pathL)
+
 def filter_list():
     """ find all files in config['blackListFileDir'] that ends in '.list', read
-        them to return one list with all entries
+        them to return one PathTrie with all entries
     """
-    filterL = []
+    filterTrie = PathTrie()
     for root, dirs, files in os.walk(config['blackListFileDir']):
         for file in files:
             if file.endswith(config['blackListFileExtension']):
                 with open(os.path.join(root, file), 'r') as f:
                     for l in f.readlines():
-                        sl = os.path.realpath(l.strip())
-                        if l.startswith('#'): next
-                        if sl:
-                            filterL.append(sl)
-    return filterL
+                        l = l.strip()
+                        if not l or l.startswith('#'):
+                            continue
+                        filterTrie.add(os.path.realpath(l))
+    return filterTrie
     
 def is_blacklisted(path, filter_list):
-    """ check if a path is blacklisted """
-    _path = os.path.normpath(path)
-    _filterL = filter(lambda e,_path=_path: os.path.commonprefix([_path, e])==e, filter_list)
-    filtered = bool(list(_filterL))
+    """ check if a path is blacklisted, filter_list is a PathTrie """
+    filtered = os.path.normpath(path) in filter_list
     if filtered:
         print('filtered %r' % path)
     return filtered
 
-if __name__=='__main__':
-    resultL = []
-    filterL = filter_list()
-    print("generated Filterlist: \n%r" % filterL)
+def backup_dirs(base_pathL, filterL, jobs=1, jobs_per_bank=None):
+    """ probe all vaults in the banks base_pathL concurrently and return
+        the directories of their latest successful backups, ordered by bank and vault.
+
+        Every bank gets its own pool of jobs_per_bank workers, so the vaults of a
+        slow bank do not occupy the workers of the others. At most jobs vaults
+        are probed at the same time.
+    """
+    jobsSemaphore = threading.BoundedSemaphore(jobs)
+    # the listings of the banks are shared by all vaults
+    fs = check_dirvish.FileSystem()
 
-    for base_path in config['base_pathL']:
-        log.debug('Find dirvish vaults in path %r', base_path)
-        for dirname, dirnames, _ in os.walk(base_path):
-            for possible_vault in dirnames:
+    def limited_backup_dir(bank, vault):
+        with jobsSemaphore:
+            return backup_dir(bank, vault, fs)
+
+    futureL = []
+    executorL = []
+    try:
+        for base_path in base_pathL:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=min(jobs_per_bank or jobs, jobs))
+            executorL.append(executor)
+            log.debug('Find dirvish vaults in path %r', base_path)
+            try:
+                entryD = fs.entries(base_path)
+            except OSError as e:
+                log.warning('Cannot list bank %r: %s', base_path, e)
+                continue
+            for possible_vault in sorted(name for name, entry in entryD.items() if entry.is_dir()):
                 possible_vault_dir = os.path.join(base_path, possible_vault)
-                if is_blacklisted(possible_vault_dir, filterL): 
+                if is_blacklisted(possible_vault_dir, filterL):
                     continue
                 print("Check directory in %r/%r" %(base_path, possible_vault))
-                backupDir = backup_dir(base_path, possible_vault)
-                if backupDir:
-                    resultL.append(os.path.join(backupDir))
-            dirnames.clear()
+                futureL.append(executor.submit(limited_backup_dir, base_path, possible_vault))
+        # the futures are in submission order, so the result does not depend on the scheduling
+        resultL = [future.result() for future in futureL]
+    finally:
+        for executor in executorL:
+            executor.shutdown()
+    return [backupDir for backupDir in resultL if backupDir]
+
+if __name__=='__main__':
+    # only the script renders the template, importing this module does not need mako
+    try:
+        from mako.template import Template
+        from mako import exceptions
+    except ImportError as e:
+        print('please install package python3-mako')
+        raise e
+
+    argp = argparse.ArgumentParser()
+    argp.add_argument('-j', '--jobs', type=int, default=config['jobs'],
+                      help='number of vaults to probe concurrently (%(default)s)')
+    argp.add_argument('--jobs-per-bank', type=int, default=config['jobsPerBank'],
+                      help='number of vaults to probe concurrently on one bank (all jobs)')
+    args = argp.parse_args()
+    filterL = filter_list()
+    print("generated Filterlist: \n%r" % filterL)
+
+    resultL = backup_dirs(config['base_pathL'], filterL, args.jobs, args.jobs_per_bank)
     with open('/etc/ptx_backup/dirvish.vault.script.sh', 'w') as file:
         try:
             template = Template(filename=config['templateFile'])